@@ -0,0 +1,89 @@
+"""
+Microbenchmark for FrameDecoder.
+
+Encodes a stream of SEND_PART frames, splits it into randomly sized segments
+the way TCP might deliver it, and reports how many bytes per second of CPU
+time a single core decodes.
+
+usage: python bench/decoder.py [frames] [part-size] [max-segment]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dsh.dsh import DshProtocol
+from dsh.decoder import FrameDecoder
+from dsh.pool import BufferPool
+
+class Sink:
+  """
+  Minimal protocol which accepts every frame and only counts payload bytes.
+  """
+  frames = DshProtocol.frames
+  bufferCommands = DshProtocol.bufferCommands
+
+  def __init__(self):
+    self.frames_received = 0
+    self.bytes_received = 0
+
+  def frameStruct(self, c):
+    return self.frames.get(c)
+
+  def frameSize(self, size):
+    return True
+
+  def frameReceived(self, c, info, data):
+    self.frames_received += 1
+    self.bytes_received += len(data)
+
+def encode(frames, partSize):
+  st = DshProtocol.frames[DshProtocol.SEND_PART]
+  payload = os.urandom(partSize)
+  digest = "\x00" * DshProtocol.digestSize
+  uid = "\x00" * 16
+
+  return "".join(
+      DshProtocol.SEND_PART + st.pack(len(payload), uid, i, 0, digest) + payload
+      for i in xrange(frames))
+
+def segment(stream, maxSegment, seed=0):
+  r = random.Random(seed)
+  pos, segments = 0, []
+
+  while pos < len(stream):
+    n = r.randint(1, maxSegment)
+    segments.append(stream[pos:pos + n])
+    pos += n
+
+  return segments
+
+def run(frames=64, partSize=2**20, maxSegment=65536):
+  stream = encode(frames, partSize)
+  segments = segment(stream, maxSegment)
+
+  sink = Sink()
+  decoder = FrameDecoder(sink, BufferPool())
+
+  start = time.clock()
+
+  for data in segments:
+    decoder.feed(data)
+
+  elapsed = time.clock() - start
+
+  assert sink.frames_received == frames
+  assert sink.bytes_received == frames * partSize
+
+  return len(stream), len(segments), elapsed
+
+if __name__ == "__main__":
+  args = [int(a) for a in sys.argv[1:]]
+  frames, partSize, maxSegment = (args + [64, 2**20, 65536][len(args):])[:3]
+
+  for m in [maxSegment / 64 or 1, maxSegment / 8 or 1, maxSegment]:
+    size, segments, elapsed = run(frames, partSize, m)
+    rate = size / elapsed / 2**20 if elapsed > 0 else float("inf")
+    print "segments <= %6d: %7d segments, %8.1f MiB/s per core" % (m, segments, rate)
@@ -0,0 +1,112 @@
+"""
+Microbenchmark for DshProtocol.sendFrame.
+
+Sends batches of control frames (REQUEST_PART, PUT_ACK) within one
+iteration of the reactor, followed by running its pending calls, and separate
+runs of SEND_PART frames, through the write path of a Twisted transport.
+Reports frames per second and how many transport writes each frame cost.
+
+usage: python bench/encoder.py [frames] [batch] [part-size]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from twisted.internet import abstract
+from twisted.internet import reactor
+
+from dsh.dsh import DshProtocol
+
+class Transport(abstract.FileDescriptor):
+  """
+  Real Twisted write path, writing to the null device instead of a socket
+  and flushed explicitly by doWrite instead of by the reactor.
+  """
+  def __init__(self):
+    abstract.FileDescriptor.__init__(self, reactor)
+    self.fd = os.open(os.devnull, os.O_WRONLY)
+    self.connected = 1
+    self.writes = 0
+
+  def fileno(self):
+    return self.fd
+
+  def startWriting(self):
+    pass
+
+  def stopWriting(self):
+    pass
+
+  def writeSomeData(self, data):
+    return os.write(self.fd, data)
+
+  def write(self, data):
+    self.writes += 1
+    abstract.FileDescriptor.write(self, data)
+
+  def writeSequence(self, seq):
+    self.writes += 1
+    abstract.FileDescriptor.writeSequence(self, seq)
+
+def connect():
+  transport = Transport()
+  protocol = DshProtocol()
+  protocol.makeConnection(transport)
+  reactor.runUntilCurrent()
+  transport.doWrite()
+  transport.writes = 0
+  return protocol, transport
+
+def control(frames, batch):
+  protocol, transport = connect()
+  uid = "\x00" * 16
+
+  start = time.clock()
+
+  for i in xrange(0, frames, batch):
+    for j in xrange(i, min(i + batch, frames)):
+      if j % 2:
+        protocol.put_ack(uid)
+      else:
+        protocol.request_part(uid, j)
+
+    reactor.runUntilCurrent()
+    transport.doWrite()
+
+  return time.clock() - start, transport
+
+def parts(frames, partSize):
+  protocol, transport = connect()
+  protocol.compressName = None
+  uid = "\x00" * 16
+  data = os.urandom(partSize)
+
+  start = time.clock()
+
+  for i in xrange(frames):
+    protocol.sendFrame(protocol.SEND_PART, info=(uid, i, 0, "\x00" * 20), data=data)
+    reactor.runUntilCurrent()
+    transport.doWrite()
+
+  return time.clock() - start, transport
+
+def report(name, frames, elapsed, transport):
+  rate = frames / elapsed if elapsed > 0 else float("inf")
+  print "%-28s %10.0f frames/s %6.2f writes/frame" % (
+      name, rate, transport.writes / float(frames))
+
+if __name__ == "__main__":
+  args = [int(a) for a in sys.argv[1:]]
+  frames, batch, partSize = (args + [100000, 8, 2**20][len(args):])[:3]
+
+  elapsed, transport = control(frames, 1)
+  report("control, unbatched", frames, elapsed, transport)
+
+  elapsed, transport = control(frames, batch)
+  report("control, %d per tick" % (batch), frames, elapsed, transport)
+
+  n = max(1, frames / 100)
+  elapsed, transport = parts(n, partSize)
+  report("SEND_PART, %d bytes" % (partSize), n, elapsed, transport)
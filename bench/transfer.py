@@ -0,0 +1,343 @@
+"""
+End-to-end transfer benchmark.
+
+Runs DshServerProtocol against DshClientPutProtocol and DshClientGetProtocol
+over localhost TCP and over an in-memory transport, for every combination of
+the given file sizes, part sizes, digest on/off and number of concurrent
+clients. Each combination runs in its own process, so that peak RSS and the
+reactor are not shared between runs.
+
+Reports MB/s, parts/s, CPU seconds per GB and peak RSS, and writes all
+results as JSON; given the JSON of an earlier run as --baseline, the change
+in MB/s of every combination is reported as well.
+
+usage: python bench/transfer.py [options], see --help
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+def parseSize(s):
+  units = {"K": 2**10, "M": 2**20, "G": 2**30}
+
+  if s[-1:].upper() in units:
+    return int(s[:-1]) * units[s[-1:].upper()]
+
+  return int(s)
+
+def sizes(s):
+  return [parseSize(v) for v in s.split(",")]
+
+def names(s):
+  return s.split(",")
+
+def configs(args):
+  for op in args.ops:
+    for transport in args.transports:
+      for size in args.sizes:
+        for partSize in args.parts:
+          for digest in args.digest:
+            for clients in args.clients:
+              yield {
+                "op": op,
+                "transport": transport,
+                "size": size,
+                "partSize": partSize,
+                "digest": digest == "on",
+                "clients": clients,
+              }
+
+def key(config):
+  return "%(op)s/%(transport)s/size=%(size)d/part=%(partSize)d/digest=%(digest)s/clients=%(clients)d" % config
+
+class Pipe:
+  """
+  One direction of an in-memory connection, written data is handed to the
+  peer protocol on the next iteration of the reactor.
+  """
+  def __init__(self, reactor):
+    self.reactor = reactor
+    self.peer = None
+    self.protocol = None
+    self.queue = list()
+    self.queued = 0
+    self.scheduled = False
+    self.paused = False
+    self.producer = None
+    self.lost = False
+    self.connected = 1
+    self.disconnecting = False
+
+  def write(self, data):
+    self.queue.append(data)
+    self.queued += len(data)
+
+    if self.producer is not None and self.queued > 2**22:
+      self.producer.pauseProducing()
+
+    self.schedule()
+
+  def writeSequence(self, seq):
+    self.write("".join(seq))
+
+  def schedule(self):
+    if not self.scheduled:
+      self.scheduled = True
+      self.reactor.callLater(0, self.deliver)
+
+  def deliver(self):
+    self.scheduled = False
+
+    while self.queue and not self.peer.paused:
+      data = self.queue.pop(0)
+      self.queued -= len(data)
+      self.peer.protocol.dataReceived(data)
+
+    if self.producer is not None and not self.queue:
+      self.producer.resumeProducing()
+
+    if self.lost and not self.queue and self.connected:
+      self.connected = self.peer.connected = 0
+      self.protocol.connectionLost(None)
+      self.peer.protocol.connectionLost(None)
+
+  def pauseProducing(self):
+    self.paused = True
+
+  def resumeProducing(self):
+    if self.paused:
+      self.paused = False
+      self.peer.schedule()
+
+  def stopProducing(self):
+    self.loseConnection()
+
+  def loseConnection(self):
+    self.lost = True
+    self.disconnecting = True
+    self.schedule()
+
+  def registerProducer(self, producer, streaming):
+    self.producer = producer
+
+  def unregisterProducer(self):
+    self.producer = None
+
+  def getPeer(self):
+    return None
+
+  def getHost(self):
+    return None
+
+def child(config):
+  """
+  Run a single configuration, returns its results.
+  """
+  from twisted.internet import reactor
+  from twisted.internet import defer
+  from twisted.internet import protocol
+
+  from dsh.dsh import DshProtocol
+  from dsh.impl import DshServerProtocol
+  from dsh.impl import DshClientPutProtocol
+  from dsh.impl import DshClientGetProtocol
+
+  DshProtocol.partSize = config["partSize"]
+  DshProtocol.checkDigest = config["digest"]
+  DshProtocol.resumeTransfers = False
+
+  tmp = tempfile.mkdtemp(prefix="dsh-bench-")
+  os.chdir(tmp)
+
+  for d in ("src", "srv", "got"):
+    os.mkdir(d)
+
+  paths = ["f%d" % (i) for i in xrange(config["clients"])]
+  data = os.urandom(min(config["size"], 2**20))
+
+  for path in paths:
+    target = config["op"] == "put" and "src" or "srv"
+    fp = open(os.path.join(target, path), "wb")
+
+    try:
+      for i in xrange(0, config["size"], len(data) or 1):
+        fp.write(data[:config["size"] - i])
+    finally:
+      fp.close()
+
+  class Server(DshServerProtocol):
+    def buildGenerator(self, path):
+      return DshServerProtocol.buildGenerator(self, os.path.join("srv", path))
+
+    def buildWriter(self, path, size, resume=False):
+      return DshServerProtocol.buildWriter(self, os.path.join("srv", path), size, resume)
+
+  class Put(DshClientPutProtocol):
+    def __init__(self, path):
+      DshClientPutProtocol.__init__(self, path)
+      self.done = defer.Deferred()
+
+    def buildGenerator(self, path):
+      return DshClientPutProtocol.buildGenerator(self, os.path.join("src", path))
+
+    def connectionLost(self, reason):
+      DshClientPutProtocol.connectionLost(self, reason)
+      self.done.callback(None)
+
+  class Get(DshClientGetProtocol):
+    def __init__(self, path):
+      DshClientGetProtocol.__init__(self, path)
+      self.done = defer.Deferred()
+
+    def buildWriter(self, path, size, resume=False):
+      return DshClientGetProtocol.buildWriter(self, os.path.join("got", path), size, resume)
+
+    def connectionLost(self, reason):
+      DshClientGetProtocol.connectionLost(self, reason)
+      self.done.callback(None)
+
+  factory = protocol.ServerFactory()
+  factory.protocol = Server
+  clients = [(config["op"] == "put" and Put or Get)(path) for path in paths]
+
+  class ClientFactory(protocol.ClientFactory):
+    def __init__(self, client):
+      self.client = client
+
+    def buildProtocol(self, addr):
+      return self.client
+
+  def connect():
+    if config["transport"] == "tcp":
+      port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+
+      for client in clients:
+        reactor.connectTCP("127.0.0.1", port.getHost().port, ClientFactory(client))
+
+      return
+
+    for client in clients:
+      server = factory.buildProtocol(None)
+      a, b = Pipe(reactor), Pipe(reactor)
+      a.peer, a.protocol, b.peer, b.protocol = b, server, a, client
+      server.makeConnection(a)
+      client.makeConnection(b)
+
+  result = dict()
+
+  def start():
+    result["usage"] = resource.getrusage(resource.RUSAGE_SELF)
+    result["start"] = time.time()
+    connect()
+
+    d = defer.DeferredList([c.done for c in clients])
+    d.addCallback(stop)
+
+  def stop(ignored):
+    result["elapsed"] = time.time() - result["start"]
+    reactor.stop()
+
+  reactor.callWhenRunning(start)
+  reactor.run()
+
+  before = result["usage"]
+  after = resource.getrusage(resource.RUSAGE_SELF)
+  cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+  total = config["size"] * config["clients"]
+  parts = -(-config["size"] // config["partSize"]) * config["clients"]
+  elapsed = result["elapsed"]
+
+  for path in paths:
+    target = config["op"] == "put" and "srv" or "got"
+
+    if os.path.getsize(os.path.join(target, path)) != config["size"]:
+      raise RuntimeError, "transfer of %s incomplete" % (path)
+
+  os.chdir("/")
+  shutil.rmtree(tmp)
+
+  return dict(config,
+    seconds=elapsed,
+    bytes=total,
+    parts=parts,
+    mb_per_s=total / elapsed / 1e6,
+    parts_per_s=parts / elapsed,
+    cpu_s_per_gb=cpu / (total / 1e9) if total else 0.0,
+    peak_rss_kb=after.ru_maxrss)
+
+def run(config):
+  p = subprocess.Popen([sys.executable, __file__, "--child", json.dumps(config)],
+      stdout=subprocess.PIPE)
+  out, err = p.communicate()
+
+  if p.returncode != 0:
+    raise RuntimeError, "%s failed with status %d" % (key(config), p.returncode)
+
+  return json.loads(out.strip().splitlines()[-1])
+
+def main():
+  parser = argparse.ArgumentParser(description="End-to-end transfer benchmark.")
+  parser.add_argument("--ops", type=names, default=["put", "get"])
+  parser.add_argument("--transports", type=names, default=["tcp", "memory"])
+  parser.add_argument("--sizes", type=sizes, default=[2**20, 64 * 2**20])
+  parser.add_argument("--parts", type=sizes, default=[2**16, 2**20])
+  parser.add_argument("--digest", type=names, default=["on", "off"])
+  parser.add_argument("--clients", type=lambda s: [int(v) for v in s.split(",")], default=[1, 4])
+  parser.add_argument("--output", default="bench-transfer.json")
+  parser.add_argument("--baseline", default=None)
+  parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child is not None:
+    print json.dumps(child(json.loads(args.child)))
+    return
+
+  baseline = dict()
+
+  if args.baseline is not None:
+    fp = open(args.baseline)
+
+    try:
+      baseline = dict((key(r), r) for r in json.load(fp)["results"])
+    finally:
+      fp.close()
+
+  results = list()
+
+  for config in configs(args):
+    r = run(config)
+    results.append(r)
+
+    line = "%-60s %9.1f MB/s %9.0f parts/s %7.2f cpu s/GB %8d KiB" % (
+        key(r), r["mb_per_s"], r["parts_per_s"], r["cpu_s_per_gb"], r["peak_rss_kb"])
+
+    if key(r) in baseline:
+      line += " %+6.1f%%" % ((r["mb_per_s"] / baseline[key(r)]["mb_per_s"] - 1) * 100)
+
+    print line
+    sys.stdout.flush()
+
+  fp = open(args.output, "w")
+
+  try:
+    json.dump({
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "time": time.time(),
+      "results": results,
+    }, fp, indent=2, sort_keys=True)
+  finally:
+    fp.close()
+
+if __name__ == "__main__":
+  main()
@@ -1,76 +1,189 @@
 #
+"""
+Entry points of dsh, only the standard library is imported until one of
+them needs more, so that the thin client which hands jobs to a running
+'dsh daemon' starts quickly.
+"""
 
+import os
 import sys
 
 ez={
     "M2Crypto" : "m2crypto",
     "twisted"  : "twisted",
     "yaml"     : "pyyaml",
+    "bencode"  : "bencode",
 }
 
-for k,i in ez.items():
-  try:
-    __import__(k)
-  except ImportError, e:
-    print("required module '%s' could not be imported: %s" % (k, e))
-    print("please run: easy_install %s" % (i))
-    sys.exit(255)
+def require():
+  """
+  Exit with instructions unless every required module can be imported.
+  """
+  for k,i in ez.items():
+    try:
+      __import__(k)
+    except ImportError, e:
+      print("required module '%s' could not be imported: %s" % (k, e))
+      print("please run: easy_install %s" % (i))
+      sys.exit(255)
+
+def socketPath():
+  """
+  Path of the UNIX socket 'dsh daemon' listens on, DSH_SOCKET if set.
+  """
+  return os.environ.get("DSH_SOCKET") or os.path.expanduser("~/.dsh/daemon.sock")
 
-from twisted.internet import reactor
-from twisted.internet import protocol
-from twisted.python import log
+def server():
+  """
+  dsh-server [-w workers] [store-dir]
 
-from .impl import DshServerProtocol
-from .impl import DshClientPutProtocol
-from .impl import DshClientGetProtocol
+  With more than one worker, that many processes serve the port, -w 0 for
+  one per core. SIGUSR1 toggles timing of handlers, digests, reads and
+  writes, SIGUSR2 captures a profile, as given by
+  DSH_PROFILE=<cprofile|sample>[:seconds].
+  """
+  import getopt
 
-def server():
-  import sys
-  import yaml
+  require()
+
+  from twisted.python import log
+  from .chunks import ChunkStore
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "w:")
+    workers = int(dict(opts).get("-w", 1))
+  except (getopt.GetoptError, ValueError), e:
+    print "usage: dsh-server [-w workers] [store-dir]"
+    sys.exit(1)
+
+  if workers <= 0:
+    import multiprocessing
+    workers = multiprocessing.cpu_count()
 
   log.startLogging(sys.stdout)
+  store = None
+
+  if args:
+    store = ChunkStore(args[0], shared=workers > 1)
+    store.collect()
+
+  if workers == 1:
+    runServer(store)
+    return
+
+  from .workers import Supervisor
+  Supervisor(workers, lambda index, sock: runServer(store, sock), 1211).serve()
+
+def runServer(store=None, sock=None):
+  """
+  Serve port 1211, or the listening socket 'sock', until stopped.
+  """
+  import socket
+
+  from twisted.internet import reactor
+  from twisted.internet import protocol
+
+  from .impl import DshServerProtocol
+  from .file import HashCache
+  from .profiler import profiler
+
+  mode, _, seconds = os.environ.get("DSH_PROFILE", "cprofile").partition(":")
+  profiler.install(int(seconds or 10), mode)
 
   factory = protocol.ServerFactory()
   factory.protocol = DshServerProtocol
   factory.db = "server.db"
-  reactor.listenTCP(1211, factory)
+  factory.hashCache = HashCache(factory.db)
+  reactor.addSystemEventTrigger("before", "shutdown", factory.hashCache.save)
+
+  if store is not None:
+    factory.chunkStore = store
+
+  if sock is None:
+    reactor.listenTCP(1211, factory)
+  else:
+    reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()
+
   reactor.run()
 
-from twisted.internet import protocol
+def viaDaemon(host, port, oper, paths):
+  """
+  Hand a GET or PUT of 'paths' to a running 'dsh daemon' and wait for it,
+  returns the exit status, or None if no daemon is listening.
+  """
+  import json
+  import socket
 
-class DshClientFactory(protocol.ClientFactory):
-  def __init__(self, reactor, protocolClass, *args, **kwargs):
-    self.reactor = reactor
-    self.protocolClass = protocolClass
-    self.args = args
-    self.kwargs = kwargs
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-  def buildProtocol(self, addr):
-    p = self.protocolClass(*self.args, **self.kwargs)
-    return p
+  try:
+    sock.connect(socketPath())
+  except socket.error:
+    sock.close()
+    return None
 
-  def clientConnectionFailed(self, transport, reason):
-    print transport, reason
-    self.reactor.stop()
+  request = {
+    "host": host,
+    "port": port,
+    "op": oper.lower(),
+    "paths": [[path, os.path.abspath(path)] for path in paths],
+  }
 
-  def clientConnectionLost(self, transport, reason):
-    print transport, reason
-    self.reactor.stop()
+  status = 0
+  fp = sock.makefile("rb")
 
-def client():
-  import sys
-  import yaml
+  try:
+    sock.sendall(json.dumps(request) + "\n")
+
+    for line in fp:
+      h = json.loads(line)
+
+      if h.get("error"):
+        print "%s: %s" % (h.get("path", oper), h["error"])
+
+      if h.get("ok") is False or (h.get("done") and h.get("error")):
+        status = 1
+
+      if h.get("done"):
+        return status
+  finally:
+    fp.close()
+    sock.close()
+
+  print "daemon closed the connection"
+  return 1
+
+def startDaemon():
+  """
+  dsh daemon
+
+  Keeps connections to servers open and runs the GET and PUT jobs handed to
+  it by dsh over the socket from socketPath().
+  """
+  require()
+
+  from twisted.python import log
+  from .daemon import serve
 
   log.startLogging(sys.stdout)
+  serve(socketPath())
 
-  if len(sys.argv) != 4:
-    print "usage: dsh <host> <oper> <file>"
+def client():
+  if sys.argv[1:] == ["daemon"]:
+    startDaemon()
+    return
+
+  if len(sys.argv) < 3 or (len(sys.argv) < 4 and sys.argv[2].upper() != "STATS"):
+    print "usage: dsh <host> <oper> <file> [file ...]"
+    print "       dsh <host> stats"
+    print "       dsh daemon"
     sys.exit(1)
 
   pp = sys.argv[1].split(":", 2)
 
   oper = sys.argv[2]
-  path = sys.argv[3]
+  paths = sys.argv[3:]
 
   if len(pp) == 2:
     host, port = pp
@@ -78,15 +191,42 @@ def client():
   else:
     host, port = pp[0], 1211
 
+  if oper.upper() in ("GET", "PUT"):
+    status = viaDaemon(host, port, oper, paths)
+
+    if status is not None:
+      sys.exit(status)
+
+  require()
+
+  from twisted.internet import reactor
+  from twisted.python import log
+
+  from .impl import DshClientFactory
+  from .impl import DshClientPutProtocol
+  from .impl import DshClientGetProtocol
+  from .impl import DshClientSyncProtocol
+  from .impl import DshClientStatsProtocol
+  from .file import HashCache
+
   factory = None
 
-  if oper.upper() == "GET":
-    factory = DshClientFactory(reactor, DshClientGetProtocol, path)
+  if oper.upper() != "STATS":
+    log.startLogging(sys.stdout)
+
+  if oper.upper() == "STATS" and not paths:
+    factory = DshClientFactory(reactor, DshClientStatsProtocol)
+  elif oper.upper() == "GET":
+    factory = DshClientFactory(reactor, DshClientGetProtocol, *paths)
   elif oper.upper() == "PUT":
-    factory = DshClientFactory(reactor, DshClientPutProtocol, path)
+    factory = DshClientFactory(reactor, DshClientPutProtocol, *paths)
+  elif oper.upper() == "SYNC" and len(paths) == 1:
+    cache = HashCache(os.path.expanduser("~/.dsh-hashes"))
+    factory = DshClientFactory(reactor, DshClientSyncProtocol, paths[0], cache=cache)
   else:
     print "invalid operation", oper
     sys.exit(2)
 
   reactor.connectTCP(host, port, factory)
   reactor.run()
+  sys.exit(factory.status)
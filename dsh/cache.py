@@ -0,0 +1,98 @@
+import collections
+import threading
+
+class PartCache:
+  """
+  Process-wide LRU cache of served parts and their digests.
+
+  Entries are keyed by (file, part), where 'file' identifies one version of
+  a file and is a tuple starting with its path, such as the key of a
+  SharedFile, and 'part' identifies the part and how it was cut and hashed.
+  Once a different version of a path is seen, every part cached for the
+  previous version is dropped. The least recently used parts are evicted
+  once the cached payloads exceed 'max_bytes'.
+
+  Parts are read from the storage pool, so the cache may be used from
+  several threads.
+  """
+  MAX_BYTES = 64 * 2 ** 20
+
+  def __init__(self, max_bytes=MAX_BYTES):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.entries = collections.OrderedDict()
+    self.files = dict()
+    self.versions = dict()
+    self._lock = threading.Lock()
+
+  def get(self, f, part):
+    """
+    Return the cached (data, digest) for 'part' of 'f', or None.
+    """
+    with self._lock:
+      entry = self.entries.pop((f, part), None)
+
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self.entries[(f, part)] = entry
+      self.hits += 1
+      return entry
+
+  def put(self, f, part, data, digest):
+    if len(data) > self.max_bytes:
+      return
+
+    with self._lock:
+      self.version(f)
+
+      key = (f, part)
+      self.discard(key)
+      self.entries[key] = (data, digest)
+      self.files.setdefault(f, set()).add(key)
+      self.size += len(data)
+
+      while self.size > self.max_bytes:
+        self.discard(next(iter(self.entries)))
+
+  def version(self, f):
+    """
+    Make 'f' the current version of its path, invalidating older versions.
+    """
+    old = self.versions.get(f[0])
+
+    if old == f:
+      return
+
+    self.versions[f[0]] = f
+
+    if old is not None:
+      self.invalidate(old)
+
+  def invalidate(self, f):
+    for key in list(self.files.get(f, ())):
+      self.discard(key)
+
+  def discard(self, key):
+    entry = self.entries.pop(key, None)
+
+    if entry is None:
+      return
+
+    self.size -= len(entry[0])
+    keys = self.files.get(key[0])
+    keys.discard(key)
+
+    if not keys:
+      del self.files[key[0]]
+
+      if self.versions.get(key[0][0]) == key[0]:
+        del self.versions[key[0][0]]
+
+"""
+The part cache shared by every connection in this process.
+"""
+cache = PartCache()
@@ -0,0 +1,421 @@
+import hashlib
+import os
+import struct
+import threading
+
+from zope.interface import implements
+
+from .interface import IWriter
+from .interface import IGenerator
+from .file import decode, encode, locked
+
+class ChunkStore:
+  """
+  Content-addressed store of files, as an alternative to storing each file
+  as a flat file.
+
+  Files are split into chunks which are stored once below 'path' by their
+  SHA1, and a manifest per file lists the digests of its chunks. Chunks are
+  reference counted by the manifests and removed once no manifest refers to
+  them, unless they are pinned by a transfer in progress. Chunks written by
+  transfers which never completed are kept until collect() is called, so
+  that a retried transfer does not need to send them again.
+
+  Reference counts are kept as a snapshot plus a log which every commit
+  appends its changes to, so a commit costs only the chunks of its file.
+  collect() folds the log into the snapshot.
+
+  Chunks are written from the storage pool, so the store may be used from
+  several threads. If 'shared' is set the store may also be used by several
+  processes: manifests are committed under a lock on the store, and chunks
+  which are no longer referred to are only removed by collect(), since the
+  chunks pinned by other processes are not known.
+  """
+  """
+  A change in the log, the digest of a chunk and the change of its count.
+  """
+  RECORD = struct.Struct("!20si")
+
+  """
+  Size of the random id the log starts with, a new log gets a new id.
+  """
+  LOG_ID = 16
+
+  def __init__(self, path, shared=False):
+    self.path = path
+    self.shared = shared
+    self.refs = dict()
+    self.pins = dict()
+    self._log = None
+    self._lock = threading.Lock()
+
+    for d in ("chunks", "files"):
+      if not os.path.isdir(os.path.join(path, d)):
+        os.makedirs(os.path.join(path, d))
+
+    with self._lock, locked(self.refsPath() + ".lock"):
+      self.update()
+
+  def refsPath(self):
+    return os.path.join(self.path, "refs")
+
+  def logPath(self):
+    return os.path.join(self.path, "refs.log")
+
+  def chunkPath(self, digest):
+    h = digest.encode("hex")
+    return os.path.join(self.path, "chunks", h[:2], h)
+
+  def manifestPath(self, path):
+    return os.path.join(self.path, "files", hashlib.sha1(path).hexdigest())
+
+  def has(self, digest):
+    return os.path.isfile(self.chunkPath(digest))
+
+  def get(self, digest):
+    fp = open(self.chunkPath(digest), "rb")
+
+    try:
+      return fp.read()
+    finally:
+      fp.close()
+
+  def pin(self, digest):
+    """
+    Keep chunk 'digest' from being removed until it is unpinned.
+    """
+    with self._lock:
+      self.pins[digest] = self.pins.get(digest, 0) + 1
+
+  def unpin(self, digests):
+    with self._lock:
+      for digest in digests:
+        pins = self.pins.pop(digest, 0) - 1
+
+        if pins > 0:
+          self.pins[digest] = pins
+
+  def put(self, data):
+    """
+    Store a chunk and pin it, returns its digest.
+    """
+    digest = hashlib.sha1(data).digest()
+    path = self.chunkPath(digest)
+    self.pin(digest)
+
+    if os.path.isfile(path):
+      return digest
+
+    directory = os.path.dirname(path)
+
+    with self._lock:
+      try:
+        os.makedirs(directory)
+      except OSError, e:
+        if not os.path.isdir(directory):
+          raise
+
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+    fp = open(tmp, "wb")
+
+    try:
+      fp.write(data)
+    finally:
+      fp.close()
+
+    os.rename(tmp, path)
+    return digest
+
+  def manifest(self, path):
+    """
+    Return the manifest of 'path', or None if it is not stored.
+    """
+    manifestPath = self.manifestPath(path)
+
+    if not os.path.isfile(manifestPath):
+      return None
+
+    return self.read(manifestPath)
+
+  def commit(self, path, size, chunkSize, digests):
+    """
+    Store the manifest of 'path', replacing any previous version.
+    """
+    with self._lock, locked(self.refsPath() + ".lock"):
+      self.update()
+
+      for digest in digests:
+        if not self.has(digest):
+          raise IOError, "missing chunk %s" % (digest.encode("hex"))
+
+      old = self.manifest(path)
+      old = old is not None and self.split(old["digests"]) or []
+      unused = list()
+
+      for digest in digests:
+        self.count(digest, 1)
+
+      for digest in old:
+        if self.count(digest, -1) <= 0:
+          unused.append(digest)
+
+      self.append([(digest, 1) for digest in digests] + [(digest, -1) for digest in old])
+      self.write(self.manifestPath(path), {
+        "path": path,
+        "size": size,
+        "chunkSize": chunkSize,
+        "digests": "".join(digests),
+      })
+
+      for digest in unused:
+        if self.shared or digest in self.refs or digest in self.pins:
+          continue
+
+        if os.path.isfile(self.chunkPath(digest)):
+          os.unlink(self.chunkPath(digest))
+
+  def open(self, path):
+    """
+    Return the manifest of 'path' with its chunks pinned, or None if it is
+    not stored.
+    """
+    with self._lock:
+      manifest = self.manifest(path)
+
+      if manifest is None:
+        return None
+
+      for digest in self.split(manifest["digests"]):
+        self.pins[digest] = self.pins.get(digest, 0) + 1
+
+      return manifest
+
+  def collect(self):
+    """
+    Remove chunks which no manifest refers to, must not be called while
+    transfers into the store are in progress.
+    """
+    with self._lock, locked(self.refsPath() + ".lock"):
+      self.update()
+
+      for dirpath, dirnames, filenames in os.walk(os.path.join(self.path, "chunks")):
+        for name in filenames:
+          if name.endswith(".tmp") or name.decode("hex") not in self.refs:
+            os.unlink(os.path.join(dirpath, name))
+
+      self.compact()
+
+  def count(self, digest, change):
+    """
+    Change the count of chunk 'digest', returns the new count.
+    """
+    refs = self.refs.pop(digest, 0) + change
+
+    if refs > 0:
+      self.refs[digest] = refs
+
+    return refs
+
+  def update(self):
+    """
+    Apply the changes appended to the log since it was last read, by this or
+    another process, called with the store locked. The snapshot is read
+    again whenever the log has been replaced by compact().
+    """
+    if not os.path.isfile(self.logPath()):
+      self.newLog()
+
+    fp = open(self.logPath(), "r+b")
+
+    try:
+      ident = fp.read(self.LOG_ID)
+
+      if self._log is not None and self._log[0] == ident:
+        offset = self._log[1]
+      else:
+        self.refs, offset = dict(), self.LOG_ID
+
+        if os.path.isfile(self.refsPath()):
+          h = self.read(self.refsPath())
+          self.refs = h["refs"]
+
+          if h["log"][0] == ident:
+            offset = h["log"][1]
+
+      fp.seek(offset)
+      data = fp.read()
+      end = len(data) - len(data) % self.RECORD.size
+
+      for pos in xrange(0, end, self.RECORD.size):
+        self.count(*self.RECORD.unpack_from(data, pos))
+
+      offset += end
+
+      if end < len(data):
+        fp.truncate(offset)
+    finally:
+      fp.close()
+
+    self._log = (ident, offset)
+
+  def append(self, changes):
+    """
+    Append 'changes', as (digest, change), to the log, called with the store
+    locked once they have been applied.
+    """
+    data = "".join(self.RECORD.pack(digest, change) for digest, change in changes)
+    fp = open(self.logPath(), "ab")
+
+    try:
+      fp.write(data)
+    finally:
+      fp.close()
+
+    self._log = (self._log[0], self._log[1] + len(data))
+
+  def compact(self):
+    """
+    Write the counts to the snapshot and start an empty log, called with the
+    store locked and the log read. The snapshot names the log and offset it
+    includes, so that the log is not applied twice if replacing it fails.
+    """
+    self.write(self.refsPath(), {"refs": self.refs, "log": list(self._log)})
+    self._log = (self.newLog(), self.LOG_ID)
+
+  def newLog(self):
+    """
+    Replace the log with an empty one, returns its random id.
+    """
+    ident = os.urandom(self.LOG_ID)
+    fp = open(self.logPath() + ".tmp", "wb")
+
+    try:
+      fp.write(ident)
+    finally:
+      fp.close()
+
+    os.rename(self.logPath() + ".tmp", self.logPath())
+    return ident
+
+  def split(self, digests):
+    return [digests[i:i + 20] for i in xrange(0, len(digests), 20)]
+
+  def read(self, path):
+    fp = open(path, "rb")
+
+    try:
+      return decode(fp.read())
+    finally:
+      fp.close()
+
+  def write(self, path, h):
+    fp = open(path + ".tmp", "wb")
+
+    try:
+      fp.write(encode(h))
+    finally:
+      fp.close()
+
+    os.rename(path + ".tmp", path)
+
+class ChunkWriter:
+  """
+  Writes each part of a file as a chunk of a ChunkStore, the file is only
+  stored once every part has been written or kept.
+  """
+  implements(IWriter)
+
+  def __init__(self, store, partSize):
+    self._store = store
+    self._partSize = partSize
+    self._path = None
+    self._size = None
+    self._digests = None
+
+  def open(self, path, size, populate=False, resume=False):
+    self._path = path
+    self._size = size
+    self._digests = [None] * self.parts()
+
+  def write(self, count, data):
+    pos = count * self._partSize
+    if self._size < pos + len(data):
+      raise ValueError, "cannot write past end of file"
+    self._digests[count] = self._store.put(data)
+
+  def keep(self, count, digest):
+    self._store.pin(digest)
+    self._digests[count] = digest
+
+  def flush(self):
+    pass
+
+  def close(self):
+    digests, self._digests = self._digests, None
+
+    try:
+      if None not in digests:
+        self._store.commit(self._path, self._size, self._partSize, digests)
+    finally:
+      self._store.unpin([d for d in digests if d is not None])
+
+  def parts(self):
+    parts, mod = divmod(self._size, self._partSize)
+    if mod != 0: parts += 1
+    return parts
+
+class ChunkGenerator:
+  """
+  Reads parts of a file stored in a ChunkStore, from chunks of any size,
+  the chunks are pinned until the generator is closed.
+  """
+  implements(IGenerator)
+
+  def __init__(self, store, path, partSize):
+    manifest = store.open(path)
+
+    if manifest is None:
+      raise IOError, "no such file: " + path
+
+    self._store = store
+    self._path = path
+    self._partSize = partSize
+    self._key = (path, hashlib.sha1(manifest["digests"]).digest())
+    self._size = manifest["size"]
+    self._chunkSize = manifest["chunkSize"]
+    self._digests = store.split(manifest["digests"])
+
+  def read(self, count):
+    pos = count * self._partSize
+    if self._size < pos:
+      raise ValueError, "cannot seek to position, size too small"
+
+    end = min(pos + self._partSize, self._size)
+    data = list()
+
+    while pos < end:
+      i, offset = divmod(pos, self._chunkSize)
+      chunk = self._store.get(self._digests[i])
+      data.append(chunk[offset:offset + end - pos])
+      pos += len(data[-1])
+
+    return "".join(data)
+
+  def size(self):
+    return self._size
+
+  def parts(self):
+    parts, mod = divmod(self._size, self._partSize)
+    if mod != 0: parts += 1
+    return parts
+
+  def key(self):
+    """
+    Identity of the version of the file being read.
+    """
+    return self._key
+
+  def close(self):
+    if self._digests is not None:
+      self._store.unpin(self._digests)
+      self._digests = None
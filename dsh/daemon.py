@@ -0,0 +1,329 @@
+import collections
+import json
+import os
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from .dsh import DshProtocol
+from .file import File
+from .impl import FileGenerator, FileWriter
+
+class Job:
+  """
+  A single GET or PUT of 'remote', from or to the local path 'local'. The
+  deferred fires with the job once it is done.
+  """
+  def __init__(self, op, remote, local):
+    self.op = op
+    self.remote = remote
+    self.local = local
+    self.deferred = defer.Deferred()
+
+class DshClientPoolProtocol(DshProtocol):
+  """
+  Long-lived client protocol which runs the jobs submitted to it,
+  concurrentTransfers at a time, and stays connected in between. The
+  connection is closed once it has been idle for idleTimeout seconds.
+  """
+  """
+  Seconds an idle connection is kept open.
+  """
+  idleTimeout = 300
+
+  def __init__(self, pool=None):
+    self.pool = pool
+    self.ready = False
+    self.jobs = dict()
+    self.gets = dict()
+    self.queue = collections.deque()
+    self.active = 0
+    self.hashing = set()
+    self.opening = None
+    self._idle = None
+
+  def load(self):
+    return self.active + len(self.queue)
+
+  def submit(self, job):
+    self.queue.append(job)
+    self.runNext()
+    return job.deferred
+
+  def connectionReady(self):
+    self.runNext()
+
+  def runNext(self):
+    while self.ready and self.queue and self.active < self.concurrentTransfers:
+      job = self.queue.popleft()
+      self.active += 1
+
+      try:
+        self.start(job)
+      except Exception, e:
+        self.failed(job, str(e))
+
+    if self._idle is not None and self._idle.active():
+      self._idle.cancel()
+
+    self._idle = None
+
+    if self.ready and self.active == 0:
+      self._idle = reactor.callLater(self.idleTimeout, self.loseConnection)
+
+  def start(self, job):
+    if job.op == "get":
+      self.gets.setdefault(job.remote, collections.deque()).append(job)
+      self.get(job.remote)
+      return
+
+    if "have" not in self.peerFeatures:
+      self.putJob(job)
+      return
+
+    self.hashing.add(job)
+
+    f = File(os.path.dirname(job.local), os.path.basename(job.local))
+    d = self.storage.run(f.metadigest)
+    d.addCallback(lambda meta: meta.hashes)
+    d.addErrback(log.err, "cannot hash %s" % (job.local))
+    d.addCallback(self.hashed, job)
+
+  def hashed(self, hashes, job):
+    if job not in self.hashing:
+      return
+
+    self.hashing.discard(job)
+
+    try:
+      self.putJob(job, hashes)
+    except Exception, e:
+      self.failed(job, str(e))
+
+  def putJob(self, job, hashes=None):
+    self.opening = job
+
+    try:
+      uid = self.putFile(job.remote, hashes)
+    finally:
+      self.opening = None
+
+    if uid is not None:
+      self.jobs[uid] = job
+
+  def buildGenerator(self, path):
+    return FileGenerator(self.opening.local, self.partSize)
+
+  def buildWriter(self, path, size, resume=False):
+    writer = FileWriter(self.partSize, self.syncParts)
+    writer.open(path, size, populate=self.preallocate, resume=resume)
+    return writer
+
+  def dsh_get_response(self, uid, size, path, version):
+    """
+    Receive into the local path of the job, so that the file and the state
+    of the transfer end up next to each other.
+    """
+    job = self.waiting(path)
+
+    if job is None:
+      self.error("unexpected get response")
+      return
+
+    self.jobs[uid] = job
+    DshProtocol.dsh_get_response(self, uid, size, job.local, version)
+
+  def waiting(self, path):
+    """
+    Take the oldest job waiting for the response to a GET of 'path'.
+    """
+    waiting = self.gets.get(path)
+
+    if not waiting:
+      return None
+
+    job = waiting.popleft()
+
+    if not waiting:
+      del self.gets[path]
+
+    return job
+
+  def transferFailed(self, uid, path, message):
+    """
+    Fail the job of transfer 'uid'. A PUT which failed to start is the job
+    being opened, a GET which failed on the server is only known by 'path'.
+    """
+    job = self.jobs.pop(uid, None)
+
+    if job is None and uid is None:
+      job = self.opening
+
+    if job is None:
+      job = self.waiting(path)
+
+    if job is not None:
+      self.failed(job, message)
+
+  def putComplete(self, uid):
+    self.done(uid)
+
+  def getComplete(self, uid):
+    self.done(uid)
+
+  def done(self, uid):
+    job = self.jobs.pop(uid, None)
+
+    if job is None:
+      return
+
+    self.active -= 1
+    job.deferred.callback(job)
+    self.runNext()
+
+  def failed(self, job, message):
+    self.active -= 1
+    job.deferred.errback(RuntimeError(message))
+    self.runNext()
+
+  def failAll(self, message):
+    jobs = list(self.jobs.values()) + list(self.queue) + list(self.hashing)
+
+    for waiting in self.gets.values():
+      jobs.extend(waiting)
+
+    self.jobs.clear()
+    self.gets.clear()
+    self.hashing.clear()
+    self.queue.clear()
+    self.active = 0
+
+    for job in jobs:
+      job.deferred.errback(RuntimeError(message))
+
+  def connectionLost(self, reason):
+    if self._idle is not None and self._idle.active():
+      self._idle.cancel()
+
+    self._idle = None
+    DshProtocol.connectionLost(self, reason)
+    self.ready = False
+
+    if self.pool is not None:
+      self.pool.lost(self)
+
+    self.failAll("connection lost: " + reason.getErrorMessage())
+
+class PoolClientFactory(protocol.ClientFactory):
+  def __init__(self, client):
+    self.client = client
+
+  def buildProtocol(self, addr):
+    self.client.factory = self
+    return self.client
+
+  def clientConnectionFailed(self, connector, reason):
+    if self.client.pool is not None:
+      self.client.pool.lost(self.client)
+
+    self.client.failAll("cannot connect: " + reason.getErrorMessage())
+
+class ConnectionPool:
+  """
+  Connections to dsh servers, reused for every job to the same server. Up to
+  'connections' are opened per server, another one only once the existing
+  ones are all running concurrentTransfers jobs.
+  """
+  def __init__(self, connections=2):
+    self.connections = connections
+    self.clients = dict()
+
+  def submit(self, host, port, job):
+    clients = self.clients.setdefault((host, port), list())
+    client = min(clients, key=lambda c: c.load()) if clients else None
+
+    if client is None or (client.load() >= client.concurrentTransfers and
+                          len(clients) < self.connections):
+      client = DshClientPoolProtocol(self)
+      client.address = (host, port)
+      clients.append(client)
+      reactor.connectTCP(host, port, PoolClientFactory(client))
+
+    return client.submit(job)
+
+  def lost(self, client):
+    clients = self.clients.get(client.address, [])
+
+    if client in clients:
+      clients.remove(client)
+
+    if not clients:
+      self.clients.pop(client.address, None)
+
+class DaemonProtocol(LineReceiver):
+  """
+  Accepts requests from thin clients over the local socket, one JSON object
+  per line as {"host", "port", "op", "paths": [[remote, local], ...]}.
+  Answers with one line per path as {"path", "ok", "error"} and a final
+  {"done": true} line.
+  """
+  delimiter = "\n"
+  MAX_LENGTH = 2**24
+
+  def lineReceived(self, line):
+    try:
+      request = json.loads(line)
+      host, port, op = str(request["host"]), int(request["port"]), str(request["op"])
+      paths = [(str(remote), str(local)) for remote, local in request["paths"]]
+
+      if op not in ("get", "put"):
+        raise ValueError, "invalid operation " + op
+    except Exception, e:
+      self.reply({"done": True, "error": "invalid request: " + str(e)})
+      self.transport.loseConnection()
+      return
+
+    results = list()
+
+    for remote, local in paths:
+      d = self.factory.pool.submit(host, port, Job(op, remote, local))
+      d.addCallbacks(self.succeeded, self.failed, errbackArgs=(remote,))
+      results.append(d)
+
+    d = defer.DeferredList(results)
+    d.addCallback(self.finished)
+
+  def succeeded(self, job):
+    self.reply({"path": job.remote, "ok": True})
+
+  def failed(self, failure, remote):
+    self.reply({"path": remote, "ok": False, "error": failure.getErrorMessage()})
+
+  def finished(self, result):
+    self.reply({"done": True})
+    self.transport.loseConnection()
+
+  def reply(self, h):
+    if self.transport.connected:
+      self.sendLine(json.dumps(h))
+
+class DaemonFactory(protocol.ServerFactory):
+  protocol = DaemonProtocol
+
+  def __init__(self, pool):
+    self.pool = pool
+
+def serve(path):
+  """
+  Serve thin clients on the UNIX socket at 'path' until stopped.
+  """
+  directory = os.path.dirname(path)
+
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+
+  reactor.listenUNIX(path, DaemonFactory(ConnectionPool()), mode=0600, wantPID=True)
+  reactor.run()
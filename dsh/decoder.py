@@ -0,0 +1,178 @@
+class FrameDecoder:
+  """
+  Incremental decoder for dsh frames.
+
+  Headers are unpacked in place from the received data whenever they are not
+  split over several segments. Payloads which arrive in a single segment are
+  handed on as a zero-copy buffer over that segment, others are gathered in a
+  bytearray leased from a BufferPool and handed on as a buffer over it; the
+  bytearray goes back to the pool once the frame has been handled. Handlers
+  must not hold on to payload buffers after they return, unless they take
+  over the bytearray with detach().
+
+  While the pool is over its limit, a frame which needs a new buffer is not
+  started; the rest of the data is kept and the protocol paused until the
+  pool wakes the decoder. A frame whose buffer is already leased is always
+  finished, so paused connections never hold a partly filled buffer.
+
+  The protocol is asked for the struct of every command through
+  frameStruct(c), to validate payload sizes through frameSize(size), and
+  given each decoded frame through frameReceived(c, info, data). Payloads of
+  commands in protocol.bufferCommands are passed as buffers, all others as
+  strings.
+  """
+  def __init__(self, protocol, pool):
+    self.protocol = protocol
+    self.pool = pool
+    self.broken = False
+    self._command = None
+    self._st = None
+    self._head = bytearray()
+    self._info = None
+    self._size = 0
+    self._buffer = None
+    self._filled = 0
+    self._stalled = None
+
+  def feed(self, data):
+    if self._stalled is not None:
+      self._stalled.append(data)
+      return
+
+    pos = 0
+    end = len(data)
+
+    if self._filled > 0 and self._filled + end < self._size:
+      self._buffer[self._filled:self._filled + end] = data
+      self._filled += end
+      return
+
+    while pos < end and not self.broken:
+      if self._command is None:
+        c = data[pos]
+        pos += 1
+
+        st = self.protocol.frameStruct(c)
+
+        if st is None:
+          self.broken = True
+          return
+
+        self._command = c
+        self._st = st
+        continue
+
+      if self._info is None:
+        need = self._st.size - len(self._head)
+
+        if not self._head and end - pos >= need:
+          values = self._st.unpack_from(data, pos)
+          pos += need
+        else:
+          n = min(need, end - pos)
+          self._head += buffer(data, pos, n)
+          pos += n
+
+          if n < need:
+            return
+
+          values = self._st.unpack_from(self._head)
+          del self._head[:]
+
+        size, info = values[0], values[1:]
+
+        if not self.protocol.frameSize(size):
+          self.broken = True
+          return
+
+        if size == 0:
+          self._dispatch(info, None)
+          continue
+
+        self._size = size
+        self._info = info
+        continue
+
+      if self._filled == 0 and end - pos >= self._size:
+        payload = buffer(data, pos, self._size)
+        pos += self._size
+        self._dispatch(self._info, payload)
+        continue
+
+      if self._buffer is None:
+        if self.pool.exceeded():
+          self._stalled = [data[pos:]]
+          self.pool.wait(self)
+          return
+
+        self._buffer = self.pool.lease(self._size)
+
+      n = min(self._size - self._filled, end - pos)
+      self._buffer[self._filled:self._filled + n] = buffer(data, pos, n)
+      self._filled += n
+      pos += n
+
+      if self._filled == self._size:
+        self._dispatch(self._info, buffer(self._buffer, 0, self._size))
+
+  def _dispatch(self, info, payload):
+    c = self._command
+
+    self._command = None
+    self._st = None
+    self._info = None
+    self._size = 0
+    self._filled = 0
+
+    if payload is not None and c not in self.protocol.bufferCommands:
+      payload = str(payload)
+
+    try:
+      self.protocol.frameReceived(c, info, payload)
+    finally:
+      self.release()
+
+  def detach(self):
+    """
+    Take over the bytearray backing the payload being handled, if any, the
+    caller must release it to the pool once done with the payload.
+    """
+    buf, self._buffer = self._buffer, None
+    return buf
+
+  def release(self):
+    """
+    Return the leased buffer, if any, to the pool.
+    """
+    if self._buffer is not None:
+      self.pool.release(self._buffer)
+      self._buffer = None
+
+  def pauseReading(self, reason):
+    self.protocol.pauseReading(reason)
+
+  def resumeReading(self, reason):
+    """
+    Called by the pool once it is below its limit, decode the data kept
+    while stalled and let the protocol read again.
+    """
+    stalled, self._stalled = self._stalled, None
+    self.protocol.resumeReading(reason)
+
+    try:
+      for i, data in enumerate(stalled or []):
+        self.feed(data)
+
+        if self._stalled is not None:
+          self._stalled.extend(stalled[i + 1:])
+          return
+    except:
+      self.broken = True
+      self.protocol.transport.loseConnection()
+      raise
+
+  def close(self):
+    self._filled = 0
+    self._stalled = None
+    self.release()
+    self.pool.cancel(self)
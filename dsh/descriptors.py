@@ -0,0 +1,128 @@
+import collections
+import os
+import threading
+
+def _libc_pread():
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    f = libc.pread64
+  except (ImportError, OSError, AttributeError):
+    return None
+
+  f.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+  f.restype = ctypes.c_ssize_t
+
+  def pread(fd, size, pos):
+    buf = ctypes.create_string_buffer(size)
+    n = f(fd, buf, size, pos)
+
+    if n < 0:
+      err = ctypes.get_errno()
+      raise OSError, (err, os.strerror(err))
+
+    return buf.raw[:n]
+
+  return pread
+
+_pread = getattr(os, "pread", None) or _libc_pread()
+
+def pread(fd, size, pos):
+  """
+  Read up to 'size' bytes at 'pos' from the file 'fd', less only at the end
+  of the file. Without a positional read this seeks first, the caller must
+  then keep other threads from moving the file position meanwhile.
+  """
+  data = list()
+  read = 0
+
+  if _pread is None:
+    os.lseek(fd, pos, os.SEEK_SET)
+
+  while read < size:
+    if _pread is None:
+      chunk = os.read(fd, size - read)
+    else:
+      chunk = _pread(fd, size - read, pos + read)
+
+    if not chunk:
+      break
+
+    data.append(chunk)
+    read += len(chunk)
+
+  return "".join(data)
+
+class SharedFile:
+  """
+  A file opened read-only, which may be read from several threads at once.
+  Parts are read with positional reads, so the file position is only used,
+  under a lock, where those are not available.
+  """
+  def __init__(self, path, key=None):
+    self.key = key
+    self.refs = 0
+    self.fp = open(path, "rb")
+    self.size = os.fstat(self.fp.fileno()).st_size
+    self._lock = threading.Lock()
+
+  def read(self, pos, size):
+    """
+    Read up to 'size' bytes at 'pos', less only at the end of the file.
+    """
+    if _pread is not None:
+      return pread(self.fp.fileno(), size, pos)
+
+    with self._lock:
+      return pread(self.fp.fileno(), size, pos)
+
+  def close(self):
+    self.fp.close()
+
+class DescriptorCache:
+  """
+  Process-wide cache of open files.
+
+  Files are keyed by path, device, inode, size and modification time, so a
+  replaced or modified file is opened again. Files are reference counted by
+  the generators reading them; up to 'keep' files which are no longer in use
+  are kept open for later generators and evicted least recently used first.
+  Evicted files are not closed, they are closed once the last generator
+  holding them is gone, so that a read still running never sees its
+  descriptor reused.
+  """
+  def __init__(self, keep=64):
+    self.keep = keep
+    self.files = dict()
+    self.unused = collections.OrderedDict()
+
+  def acquire(self, path):
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    f = self.files.get(key)
+
+    if f is None:
+      f = SharedFile(path, key)
+      self.files[key] = f
+
+    self.unused.pop(key, None)
+    f.refs += 1
+    return f
+
+  def release(self, f):
+    f.refs -= 1
+
+    if f.refs > 0:
+      return
+
+    self.unused[f.key] = f
+
+    while len(self.unused) > self.keep:
+      key, old = self.unused.popitem(last=False)
+      self.files.pop(key, None)
+
+"""
+The descriptor cache shared by every connection in this process.
+"""
+descriptors = DescriptorCache()
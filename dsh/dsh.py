@@ -1,28 +1,260 @@
 from twisted.internet import protocol
+from twisted.internet import reactor
 from twisted.python import log
 
 import struct
 import cStringIO
+import os
+import time
+import bencode
+import hashlib
+import zlib
+import bz2
 
 from .interface import IWriter
 from .interface import IGenerator
+from .parts import ReceiveState
+from .file import File, FileMeta, MetaPackage
+from .producer import PartProducer
+from .decoder import FrameDecoder
+from .pool import pool
+from .storage import storage
+from .metrics import metrics
+from .profiler import profiler
+
+def bz2Decompress(data, size, step=64):
+  """
+  Decompress 'data' but stop once more than 'size' bytes came out. The bz2
+  decompressor has no output limit, so the input is fed in small steps and
+  at most about one bz2 block (46 MB) is decompressed past 'size'.
+  """
+  d = bz2.BZ2Decompressor()
+  out = list()
+  length = 0
+
+  for i in xrange(0, len(data), step):
+    chunk = d.decompress(data[i:i + step])
+    out.append(chunk)
+    length += len(chunk)
+
+    if length > size:
+      break
+
+  return "".join(out)[:size]
 
 class DshProtocol(protocol.Protocol):
   enablePutFile = False
   enableGetFile = False
+  enableSyncFile = False
+  enableStats = False
   checkDigest = True
 
   """
-  The size of the digest from digestFunction..
+  Log every frame sent and received, this is expensive and off by default.
+  """
+  logFrames = False
+
+  """
+  The size of the digest from digestFunction, until a HELLO has been
+  exchanged this is the size of the default digest.
   """
   digestSize = 20
 
+  """
+  The digest in use, until a HELLO has been exchanged this is the default.
+  """
+  digestName = "sha1"
+
+  """
+  Digest algorithms offered in HELLO, in order of preference.
+  """
+  digestNames = ["sha1", "sha256", "md5", "crc32", "adler32"]
+
+  """
+  Compression algorithms offered in HELLO, in order of preference, parts are
+  only compressed if both sides have a compressor in common.
+  """
+  compressNames = ["zlib"]
+
+  """
+  Parts are only sent compressed if that makes them smaller than this ratio
+  of their original size.
+  """
+  compressRatio = 0.9
+
+  """
+  Number of parts of a transfer sent without trying to compress them after a
+  part did not compress well.
+  """
+  compressSkip = 8
+
+  """
+  Largest part size offered in HELLO, the smallest of the two offers is used.
+  """
+  partSize = 2**20
+
+  """
+  Smallest part size accepted from the peer in HELLO.
+  """
+  minPartSize = 2**12
+
+  """
+  Pool which receive buffers are leased from, shared by all connections.
+  """
+  bufferPool = pool
+
+  """
+  Thread pool which generators are read and writers written from.
+  """
+  storage = storage
+
+  """
+  Registry which transfer metrics are counted in, shared by all connections.
+  """
+  metrics = metrics
+
+  """
+  Profiler which handlers, digests, reads and writes are timed by.
+  """
+  profiler = profiler
+
+  """
+  Number of parts of a transfer which may be waiting to be written before
+  reading from the connection is paused.
+  """
+  writeQueueMax = 16
+
+  """
+  Number of parts which are read from generators at the same time.
+  """
+  readAhead = 2
+
+  """
+  Frames with at most this much payload are held back and written together
+  with the other frames produced in the same reactor iteration.
+  """
+  coalesceMax = 4096
+
+  """
+  Number of part requests kept in flight for every receiving transfer.
+  """
+  windowSize = 8
+
+  """
+  Number of free window slots required before more parts are requested, so
+  that a single REQUEST_RANGE can cover several parts.
+  """
+  windowRefill = 4
+
+  """
+  Number of files a client transfers at the same time over one connection.
+  """
+  concurrentTransfers = 8
+
+  """
+  Files of at most this size are put in bundles, several of them sharing
+  parts of one transfer.
+  """
+  bundleFileMax = 2**18
+
+  """
+  Largest number of files and of parts in a single bundle.
+  """
+  bundleFiles = 1024
+  bundleParts = 16
+
+  """
+  Persist receive state next to partially written files, so that an
+  interrupted transfer only requests the parts that are still missing.
+  """
+  resumeTransfers = True
+
+  """
+  Number of received parts after which the receive state is saved again.
+  """
+  saveInterval = 64
+
+  """
+  Allocate the full size of received files up front where the file system
+  can do so without writing, instead of extending them sparsely.
+  """
+  preallocate = True
+
+  """
+  Number of written parts after which received files are synced to disk,
+  0 to only sync when the receive state is saved and when a file is closed.
+  """
+  syncParts = 0
+
+  """
+  Known digest algorithms, as name: (size, function).
+  """
+  digests = {
+    "sha1"    : (20, lambda data: hashlib.sha1(data).digest()),
+    "sha256"  : (32, lambda data: hashlib.sha256(data).digest()),
+    "md5"     : (16, lambda data: hashlib.md5(data).digest()),
+    "crc32"   : (4, lambda data: struct.pack("!I", zlib.crc32(buffer(data)) & 0xffffffff)),
+    "adler32" : (4, lambda data: struct.pack("!I", zlib.adler32(buffer(data)) & 0xffffffff)),
+  }
+
+  if hasattr(hashlib, "blake2b"):
+    digests["blake2b"] = (32, lambda data: hashlib.blake2b(data, digest_size=32).digest())
+
+  """
+  Known compression algorithms, as name: (compress, decompress) where
+  decompress is given the maximum size of the result.
+  """
+  compressors = {
+    "zlib" : (lambda data: zlib.compress(buffer(data), 1),
+              lambda data, size: zlib.decompressobj().decompress(data, size)),
+    "bz2"  : (lambda data: bz2.compress(buffer(data), 1),
+              bz2Decompress),
+  }
+
+  try:
+    import lzma
+    compressors["lzma"] = (lambda data: lzma.compress(bytes(data), preset=1),
+                           lambda data, size: lzma.LZMADecompressor().decompress(data, size))
+  except ImportError:
+    pass
+
+  COMPRESSED = 0x01
+
   def digestFunction(self, data):
     """
-    The digestfunction to use, defaults to 'sha1'.
+    The digestfunction to use, as agreed in HELLO, defaults to 'sha1'.
+    """
+    f = self.digests[self.digestName][1]
+
+    if self.profiler.enabled:
+      f = self.profiler.timed(f, "digest." + self.digestName)
+
+    return f(data)
+
+  def partDigest(self, data):
+    """
+    The digest sent along with a part, zeroes unless checkDigest is set.
+    """
+    if self.checkDigest:
+      return self.digestFunction(data)
+
+    return "\x00" * self.digestSize
+
+  NO_VERSION = "\x00" * 20
+
+  def sourceVersion(self, generator):
+    """
+    Token identifying the version of the data read by 'generator', sent
+    along with PUT, SYNC and GET_RESPONSE so that an interrupted transfer is
+    only resumed from the same version. NO_VERSION unless the generator has
+    a key().
     """
-    import hashlib
-    return hashlib.sha1(data).digest();
+    key = getattr(generator, "key", None)
+
+    if key is None:
+      return self.NO_VERSION
+
+    return hashlib.sha1(repr(key())).digest()
 
   def generateUuid(self):
     import uuid
@@ -30,40 +262,157 @@ class DshProtocol(protocol.Protocol):
 
   HEADER           = "!I"
 
+  VERSION         = 3
+
+  HELLO           = "\x01"
+  HELLO_st        = HEADER + "HI"
   PUT             = "\x10"
-  PUT_st          = HEADER + "16sQ"
+  PUT_st          = HEADER + "16sQ20s"
   PUT_ACK         = "\x15"
   PUT_ACK_st      = HEADER + "16s"
   REQUEST_PART    = "\x40"
   REQUEST_PART_st = HEADER + "16sI"
+  REQUEST_RANGE   = "\x42"
+  REQUEST_RANGE_st = HEADER + "16sII"
   SEND_PART       = "\x41"
-  SEND_PART_st    = HEADER + "16sI%ss" % ( str(digestSize) )
+  SEND_PART_st    = HEADER + "16sIB%ss" % ( str(digestSize) )
   GET             = "\x20"
   GET_st          = HEADER + ""
   GET_RESPONSE    = "\x25"
-  GET_RESPONSE_st = HEADER + "16sQ"
+  GET_RESPONSE_st = HEADER + "16sQ20s"
+  SYNC            = "\x30"
+  SYNC_st         = HEADER + "16sQ20s"
+  SYNC_HASHES     = "\x32"
+  SYNC_HASHES_st  = HEADER + "16sI"
+  BUNDLE          = "\x50"
+  BUNDLE_st       = HEADER + "16sQ"
+  HAVE            = "\x60"
+  HAVE_st         = HEADER + "16sI"
+  HAVE_RESPONSE   = "\x65"
+  HAVE_RESPONSE_st = HEADER + "16sI"
+  STATS           = "\x70"
+  STATS_st        = HEADER + ""
+  STATS_RESPONSE  = "\x75"
+  STATS_RESPONSE_st = HEADER + ""
   ERROR           = "\x80"
   ERROR_st        = HEADER + ""
+  TRANSFER_ERROR  = "\x85"
+  TRANSFER_ERROR_st = HEADER + "16s"
   DISABLED        = "\x90"
   DISABLED_st     = HEADER + ""
 
   DATA_MAX         = 2**20
-  READ_MAX         = DATA_MAX + 32
   RESEND_MAX       = 16
 
   frames = {
+    HELLO         : struct.Struct(HELLO_st),
     PUT           : struct.Struct(PUT_st),
     PUT_ACK       : struct.Struct(PUT_ACK_st),
     REQUEST_PART  : struct.Struct(REQUEST_PART_st),
+    REQUEST_RANGE : struct.Struct(REQUEST_RANGE_st),
     SEND_PART     : struct.Struct(SEND_PART_st),
     GET           : struct.Struct(GET_st),
     GET_RESPONSE  : struct.Struct(GET_RESPONSE_st),
+    SYNC          : struct.Struct(SYNC_st),
+    SYNC_HASHES   : struct.Struct(SYNC_HASHES_st),
+    BUNDLE        : struct.Struct(BUNDLE_st),
+    HAVE          : struct.Struct(HAVE_st),
+    HAVE_RESPONSE : struct.Struct(HAVE_RESPONSE_st),
+    STATS         : struct.Struct(STATS_st),
+    STATS_RESPONSE : struct.Struct(STATS_RESPONSE_st),
     ERROR         : struct.Struct(ERROR_st),
+    TRANSFER_ERROR : struct.Struct(TRANSFER_ERROR_st),
     DISABLED      : struct.Struct(DISABLED_st),
   }
 
   commands = set(frames.keys())
 
+  """
+  Commands which are accepted before the HELLO handshake has completed.
+  """
+  handshake = set([HELLO, ERROR, DISABLED])
+
+  """
+  Commands whose payload is handed to their handler as a buffer instead of a
+  string, the handler must not keep it after returning.
+  """
+  bufferCommands = set([SEND_PART])
+
+  def dsh_HELLO(self, info, data):
+    version, partSize = info
+
+    if self.ready:
+      self.error("duplicate hello")
+      return
+
+    if version != self.VERSION:
+      self.error("unsupported version %d" % (version))
+      return
+
+    try:
+      h = bencode.bdecode(data)
+      digestNames = list(h.get("digests", []))
+      compressNames = list(h.get("compressors", []))
+      features = list(h.get("features", []))
+    except Exception, e:
+      self.error("invalid hello")
+      return
+
+    self.dsh_hello(partSize, digestNames, compressNames, features)
+
+  def dsh_hello(self, partSize, digestNames, compressNames, features=[]):
+    """
+    Agree on part size, digest and compression with the peer, both sides run
+    the same selection on both offers so they end up with the same values.
+    The optional features the peer supports are kept in peerFeatures.
+    """
+    if partSize < self.minPartSize:
+      self.error("invalid part size %d" % (partSize))
+      return
+
+    digest = self.select(self.digestNames, digestNames, self.digests)
+
+    if digest is None:
+      self.error("no common digest")
+      return
+
+    self.digestName = digest
+    self.digestSize = self.digests[self.digestName][0]
+    self.compressName = self.select(self.compressNames, compressNames, self.compressors)
+    self.partSize = min(self.partSize, partSize)
+    self.peerFeatures = set(features)
+
+    st = self.HEADER + "16sIB%ss" % (str(self.digestSize))
+    self.frames = dict(self.frames)
+    self.frames[self.SEND_PART] = struct.Struct(st)
+
+    self.ready = True
+    self.connectionReady()
+
+  def select(self, ours, theirs, known):
+    """
+    Select the name offered by both sides with the best combined rank, or None.
+    """
+    common = [n for n in ours if n in theirs and n in known]
+
+    if not common:
+      return None
+
+    return min(common, key=lambda n: (ours.index(n) + theirs.index(n), n))
+
+  def connectionReady(self):
+    """
+    Called once the HELLO handshake has completed, override to start
+    transfers.
+    """
+
+  def features(self):
+    """
+    Override to offer optional features in HELLO, such as "have" once HAVE
+    queries are answered or "bundle" once BUNDLE is.
+    """
+    return []
+
   def dsh_GET(self, info, data):
     if not self.enableGetFile:
       self.disabled("GET")
@@ -72,17 +421,113 @@ class DshProtocol(protocol.Protocol):
     self.dsh_get(data)
 
   def dsh_GET_RESPONSE(self, info, data):
-    uid, size = info
-    self.dsh_get_response(uid, size, data)
+    uid, size, version = info
+    self.dsh_get_response(uid, size, data, version)
 
   def dsh_PUT(self, info, data):
-    uid, size = info
+    uid, size, version = info
 
     if not self.enablePutFile:
       self.disabled("PUT")
       return
 
-    self.dsh_put(uid, size, data)
+    self.dsh_put(uid, size, data, version)
+
+  def dsh_SYNC(self, info, data):
+    uid, size, version = info
+
+    if not self.enableSyncFile:
+      self.disabled("SYNC")
+      return
+
+    hashes = sorted(self._syncHashes.pop(uid, []))
+
+    try:
+      h = bencode.bdecode(data)
+      base, meta = h.get("base"), FileMeta.load(h.get("file"))
+
+      pos = 0
+
+      for start, chunk in hashes:
+        if start * 20 != pos:
+          raise ValueError, "manifest hashes are not contiguous"
+
+        pos += len(chunk)
+
+      meta = FileMeta(meta.path, meta.size, "".join(chunk for start, chunk in hashes))
+    except Exception, e:
+      self.error("invalid sync manifest")
+      return
+
+    self.dsh_sync(uid, size, base, meta, version)
+
+  def dsh_SYNC_HASHES(self, info, data):
+    uid, start = info
+
+    if not self.enableSyncFile:
+      self.disabled("SYNC")
+      return
+
+    if data is None or len(data) % 20 != 0:
+      self.error("invalid sync manifest")
+      return
+
+    self._syncHashes.setdefault(uid, list()).append((start, data))
+
+  def dsh_BUNDLE(self, info, data):
+    uid, size = info
+
+    if not self.enablePutFile:
+      self.disabled("BUNDLE")
+      return
+
+    try:
+      h = bencode.bdecode(data)
+      base, package = h.get("base"), MetaPackage.load(h.get("package"))
+    except Exception, e:
+      self.error("invalid bundle index")
+      return
+
+    self.dsh_bundle(uid, size, base, package)
+
+  def dsh_HAVE(self, info, data):
+    uid, start = info
+
+    if not self.enablePutFile:
+      self.disabled("HAVE")
+      return
+
+    if not data or len(data) % 20 != 0:
+      self.error("invalid have query")
+      return
+
+    digests = [data[i:i + 20] for i in xrange(0, len(data), 20)]
+    self.dsh_have(uid, start, digests)
+
+  def dsh_HAVE_RESPONSE(self, info, data):
+    uid, start = info
+
+    if not data:
+      self.error("invalid have response")
+      return
+
+    self.dsh_have_response(uid, start, bytearray(data))
+
+  def dsh_STATS(self, info, data):
+    if not self.enableStats:
+      self.disabled("STATS")
+      return
+
+    self.dsh_stats()
+
+  def dsh_STATS_RESPONSE(self, info, data):
+    try:
+      stats = bencode.bdecode(data)
+    except Exception, e:
+      self.error("invalid stats")
+      return
+
+    self.dsh_stats_response(stats)
 
   def dsh_PUT_ACK(self, info, data):
     uid = info[0]
@@ -92,13 +537,47 @@ class DshProtocol(protocol.Protocol):
     uid, count = info
     self.dsh_request_part(uid, count)
 
+  def dsh_REQUEST_RANGE(self, info, data):
+    uid, start, count = info
+    self.dsh_request_range(uid, start, count)
+
   def dsh_SEND_PART(self, info, data):
-    uid, count, digest = info
-    self.dsh_send_part(uid, count, digest, data)
+    uid, count, flags, digest = info
+
+    if not flags & self.COMPRESSED:
+      self.dsh_send_part(uid, count, digest, data)
+      return
+
+    d = self.storage.run(self.profiler.timed(self.decompress), str(data))
+    d.addCallbacks(self._decompressed, self._decompressFailed,
+        callbackArgs=(uid, count, digest), errbackArgs=(uid, count))
+
+  def _decompressed(self, data, uid, count, digest):
+    if self.connected and uid not in self._dropped:
+      self.dsh_send_part(uid, count, digest, data, decoded=True)
+
+  def _decompressFailed(self, failure, uid, count):
+    log.msg("cannot decompress part %d: %s" % (count, failure.getErrorMessage()))
+
+    if self.connected and uid in self._recv:
+      self._recv[uid][2][count] = time.time()
+      self.request_part(uid, count)
 
   def dsh_ERROR(self, info, data):
     self.dsh_error(data)
 
+  def dsh_TRANSFER_ERROR(self, info, data):
+    uid = info[0]
+
+    try:
+      h = bencode.bdecode(data)
+      path, message = str(h["path"]), str(h["message"])
+    except Exception, e:
+      self.error("invalid transfer error")
+      return
+
+    self.dsh_transfer_error(uid, path, message)
+
   def dsh_DISABLED(self, info, data):
     self.dsh_disabled(data)
 
@@ -107,103 +586,403 @@ class DshProtocol(protocol.Protocol):
     Override to implement GET.
     """
     uid = self.generateUuid()
-    generator = self.buildGenerator(path) 
 
-    if not IGenerator.providedBy(generator):
-      log.msg("invalid generator: %s" % (repr(generator)))
-      self.error("invalid generator")
+    try:
+      generator = self.openGenerator(path)
+    except Exception, e:
+      self.abortTransfer(uid, path, "cannot get: " + str(e))
       return
-    
+
     self._send[uid] = (uid, path, generator)
 
     size = generator.size()
+    self.metrics.start(uid, "send", path, size)
 
-    self.get_response(uid, size, path)
+    self.get_response(uid, size, path, self.sourceVersion(generator))
 
-  def dsh_get_response(self, uid, size, path):
+  def dsh_get_response(self, uid, size, path, version):
     """
     Override to implement GET_RESPONSE
     """
-    recv, writer = self.recvFile(uid, size, path)
+    try:
+      self.recvFile(uid, size, path, version=version)
+    except Exception, e:
+      self.abortTransfer(uid, path, "cannot get: " + str(e))
+      return
+
+    self.requestParts(uid)
+
+  def dsh_put(self, uid, size, path, version):
+    have = self._have.pop(uid, None)
 
     try:
-      count = recv.index(False)
-    except ValueError, e:
-      self.put_ack(uid)
+      self.recvFile(uid, size, path, have or None, version)
+    except Exception, e:
+      self.abortTransfer(uid, path, "cannot put: " + str(e))
       return
 
-    self.request_part(uid, count)
+    self.requestParts(uid)
+
+  def dsh_have(self, uid, start, digests):
+    """
+    Answer which of the 1 MiB chunks 'start' and on, given by their SHA1, are
+    already present, the present ones are not requested by a following PUT
+    of 'uid'.
+    """
+    bitmap = bytearray((len(digests) + 7) / 8)
+
+    if self.partSize == File.CHUNK_SIZE:
+      have = self._have.setdefault(uid, list())
+
+      for i, present in enumerate(self.findChunks(digests)):
+        if present:
+          bitmap[i >> 3] |= 1 << (i & 7)
+          have.append((start + i, digests[i]))
+
+    self.have_response(uid, start, str(bitmap))
+
+  def dsh_stats(self):
+    """
+    Answer a STATS request with a snapshot from statistics().
+    """
+    self.stats_response(bencode.bencode(self.statistics()))
 
-  def dsh_put(self, uid, size, path):
-    recv, writer = self.recvFile(uid, size, path)
+  def dsh_stats_response(self, stats):
+    """
+    Override to handle the snapshot of the peer's metrics, by default it is
+    logged.
+    """
+    log.msg("stats: %s" % (repr(stats)))
+
+  def statistics(self):
+    """
+    Snapshot of the metrics reported to STATS requests, override to add more.
+    """
+    stats = self.metrics.snapshot()
+
+    if self.profiler.timings:
+      stats["profile"] = self.profiler.snapshot()
+
+    return stats
+
+  def dsh_have_response(self, uid, start, bitmap):
+    """
+    Override to handle HAVE responses, by default the number of chunks the
+    peer already has is logged.
+    """
+    present = sum(bin(b).count("1") for b in bitmap)
+    log.msg("peer has %d chunks from %d" % (present, start))
+
+  def findChunks(self, digests):
+    """
+    Override to answer HAVE queries, returns whether each chunk with the
+    given SHA1 is present, by default none are.
+    """
+    return [False] * len(digests)
+
+  def dsh_sync(self, uid, size, base, meta, version):
+    """
+    Override to implement SYNC, only the parts which differ from the local
+    copy of the file described by 'meta' are requested.
+    """
+    d = self.storage.run(self.compareFile, base, meta)
+    d.addCallbacks(self._compared, self._compareFailed,
+        callbackArgs=(uid, size, version), errbackArgs=(uid, base, meta))
+
+  def _compared(self, result, uid, size, version):
+    path, have = result
+
+    if not self.connected:
+      return
+
+    if self.partSize != File.CHUNK_SIZE:
+      have = None
 
     try:
-      count = recv.index(False)
-    except ValueError, e:
-      self.put_ack(uid)
+      self.recvFile(uid, size, path, have, version)
+    except Exception, e:
+      self.abortTransfer(uid, path, "cannot sync: " + str(e))
+      return
+
+    self.requestParts(uid)
+
+  def _compareFailed(self, failure, uid, base, meta):
+    if self.connected:
+      path = os.path.join(base, *meta.path)
+      self.abortTransfer(uid, path, "cannot sync: " + failure.getErrorMessage())
+
+  def dsh_bundle(self, uid, size, base, package):
+    """
+    Override to implement BUNDLE, the files in 'package' are received as one
+    transfer and unpacked below 'base' by the writer from buildBundleWriter.
+    Only puts are bundled, there is no bundled GET response.
+    """
+    if uid in self._recv:
+      self.error("transfer already active")
+      return
+
+    try:
+      writer = self.buildBundleWriter(base, package, size)
+    except Exception, e:
+      self.abortTransfer(uid, base, "cannot bundle: " + str(e))
+      return
+
+    if not IWriter.providedBy(writer):
+      log.msg("invalid writer: %s" % (repr(writer)))
+      self.error("invalid writer")
       return
 
-    self.request_part(uid, count)
+    recv = ReceiveState(uid, base, size, writer.parts(), self.digestSize)
+    recv.resumable = False
+    self._recv[uid] = (recv, writer, dict())
+    self.metrics.start(uid, "recv", base, size)
+    self.requestParts(uid)
 
   def dsh_put_ack(self, uid):
     """
     Override to implement PUT ACK.
     """
+    if uid in self._dropped:
+      return
+
     if uid not in self._send:
       self.error("no transfer in progress")
       return
 
-    self._send.pop(uid)
+    uid, path, generator = self._send.pop(uid)
+    generator.close()
+    self._producer.cancel(uid)
+    self._skip.pop(uid, None)
+    self.metrics.finish(uid, "send")
     self.putComplete(uid)
 
-  def dsh_send_part(self, uid, count, digest, data):
+  def dsh_send_part(self, uid, count, digest, data, decoded=False):
+    """
+    Handle a received part, 'decoded' is True if 'data' was decompressed
+    after the frame was handled and so holds no buffer of the decoder.
+    """
+    if uid in self._dropped:
+      return
+
     if uid not in self._recv:
       self.error("no matching transfer in progress")
       return
 
-    recv, writer = self._recv[uid]
+    recv, writer, inflight = self._recv[uid]
+
+    if count not in inflight:
+      self.error("part not requested")
+      return
 
     if self.checkDigest:
       if self.digestFunction(data) != digest:
+        self.metrics.mismatch(uid)
+        inflight[count] = time.time()
         self.request_part(uid, count)
         return
 
-    recv[count] = True
-    done = False
+    recv.add(count, digest)
+    self.metrics.received(uid, len(data), time.time() - inflight.pop(count))
+    recv.writing.add(count)
 
-    try:
-      missing = recv.index(False)
-      self.request_part(uid, missing)
-    except ValueError, e:
+    d = self.receivedPart(writer, count, data)
+    d.addCallbacks(self._written, self._writeFailed,
+        callbackArgs=(recv, count), errbackArgs=(recv, count))
+    d.addBoth(self._release, recv, None if decoded else self._decoder.detach())
+
+    if len(recv.writing) >= self.writeQueueMax:
+      self.pauseReading(recv)
+
+    if not self.fillWindow(uid):
       self._recv.pop(uid)
-      done = True
-      self.put_ack(uid)
-    
-    self.receivedPart(writer, count, data, done)
+      self.completeTransfer(uid, recv, writer)
+    elif self.resumeTransfers and recv.unsaved >= self.saveInterval:
+      if recv.resumable and not recv.saving:
+        self.saveState(recv, writer)
+
+  def receivedPart(self, writer, count, data):
+    """
+    Override this to handle file part reception, returns a Deferred which
+    fires once the part has been written.
+    """
+    return self.storage.run(self.profiler.timed(writer.write), count, data)
+
+  def _written(self, result, recv, count):
+    recv.written(count)
+
+  def _writeFailed(self, failure, recv, count):
+    log.err(failure, "cannot write part %d of %s" % (count, recv.path))
+    recv.written(count, False)
+
+    if recv.uid not in self._dropped:
+      self.abortTransfer(recv.uid, recv.path, "cannot write part %d: %s" % (
+          count, failure.getErrorMessage()))
+
+  def _release(self, result, recv, buf):
+    if buf is not None:
+      self.bufferPool.release(buf)
+
+    if len(recv.writing) < self.writeQueueMax:
+      self.resumeReading(recv)
+
+  def completeTransfer(self, uid, recv, writer):
+    """
+    Close the writer of transfer 'uid' once every part has been written, then
+    acknowledge the transfer.
+    """
+    def closed(result):
+      if not recv.complete():
+        self.metrics.finish(uid, "recv", False)
+        return
+
+      self.clearState(recv)
+      self.metrics.finish(uid, "recv")
+
+      if self.connected:
+        self.put_ack(uid)
 
-    if done:
       self.getComplete(uid)
 
-  def receivedPart(self, writer, count, data, done):
+    def failed(failure):
+      log.err(failure, "cannot complete %s" % (recv.path))
+      self.metrics.finish(uid, "recv", False)
+      self.abortTransfer(uid, recv.path, "cannot complete transfer")
+
+    d = self.closeWriter(recv, writer)
+    d.addCallbacks(closed, failed)
+    return d
+
+  def closeWriter(self, recv, writer):
     """
-    Override this to handle file part reception.
+    Close the writer once no parts are being written, the receive state is
+    saved first unless every part has been received.
     """
-    if done:
-      writer.write(count, data)
-      writer.close()
-      return
+    def drained(result):
+      if self.resumeTransfers and recv.resumable and not recv.complete():
+        return self.saveState(recv, writer)
 
-    writer.write(count, data)
+    d = recv.drained()
+    d.addCallback(drained)
+    d.addCallback(lambda result: self.storage.run(writer.close))
+    return d
 
   def buildGenerator(self, path):
     """
     Implement to create a generator, a source of data.
     """
 
-  def buildWriter(self, path, size):
+  def compareFile(self, base, meta):
+    """
+    Implement to compare the local file described by 'meta' below 'base',
+    returns the local path and a list of (count, digest) for the parts which
+    are already up to date. Called from the storage pool.
+    """
+
+  def buildWriter(self, path, size, resume=False):
+    """
+    Implemen to create a writer, a target of data, if resume is True any
+    existing data at the target must be kept.
+    """
+
+  def buildBundleGenerator(self, base, package):
+    """
+    Implement to create a generator of the files in 'package' below 'base',
+    one after the other.
+    """
+
+  def buildBundleWriter(self, base, package, size):
+    """
+    Implement to create a writer which unpacks a bundle of 'size' bytes into
+    the files in 'package' below 'base'.
+    """
+
+  def statePath(self, path):
+    """
+    Path of the file which holds the receive state for 'path'.
+    """
+    return path + ".dsh"
+
+  def loadState(self, uid, path, size, version=None):
+    """
+    Load persisted receive state for 'path', returns None unless there is
+    resumable state matching the given size, saved while receiving the same
+    'version' of the source.
+    """
+    if not self.resumeTransfers or not version or version == self.NO_VERSION:
+      return None
+
+    statePath = self.statePath(path)
+
+    if not os.path.isfile(statePath) or not os.path.isfile(path):
+      return None
+
+    try:
+      fp = open(statePath, "rb")
+
+      try:
+        recv = ReceiveState.loads(fp.read())
+      finally:
+        fp.close()
+    except Exception, e:
+      log.msg("ignoring invalid state %s: %s" % (statePath, str(e)))
+      return None
+
+    parts, mod = divmod(size, self.partSize)
+    if mod != 0: parts += 1
+
+    if recv.path != path or recv.size != size or recv.parts.parts != parts:
+      return None
+
+    if recv.digestSize != self.digestSize:
+      return None
+
+    if recv.version != version:
+      log.msg("discarding state of %s, the source has changed" % (path))
+      return None
+
+    recv.uid = uid
+    return recv
+
+  def saveState(self, recv, writer):
+    """
+    Flush the writer and persist the receive state next to the written file,
+    returns a Deferred which fires once the state has been written.
+    """
+    data = recv.dumps()
+    recv.unsaved = 0
+    recv.saving = True
+
+    d = self.storage.run(self.writeState, self.statePath(recv.path), data, writer)
+    d.addErrback(log.err, "cannot save state of %s" % (recv.path))
+    d.addBoth(lambda result: recv.saved())
+    return d
+
+  def writeState(self, statePath, data, writer):
+    """
+    Flush the writer and write the state, called from the storage pool.
+    """
+    writer.flush()
+
+    fp = open(statePath + ".tmp", "wb")
+
+    try:
+      fp.write(data)
+    finally:
+      fp.close()
+
+    os.rename(statePath + ".tmp", statePath)
+
+  def clearState(self, recv):
     """
-    Implemen to create a writer, a target of data.
+    Remove persisted receive state once a transfer has completed.
     """
+    if not recv.resumable:
+      return
+
+    statePath = self.statePath(recv.path)
+
+    if os.path.isfile(statePath):
+      os.unlink(statePath)
 
   def putComplete(self, uid):
     """
@@ -216,13 +995,23 @@ class DshProtocol(protocol.Protocol):
     """
 
   functions = {
+    HELLO            : dsh_HELLO,
     PUT              : dsh_PUT,
     PUT_ACK          : dsh_PUT_ACK,
     GET              : dsh_GET,
     GET_RESPONSE     : dsh_GET_RESPONSE,
+    SYNC             : dsh_SYNC,
+    SYNC_HASHES      : dsh_SYNC_HASHES,
+    BUNDLE           : dsh_BUNDLE,
+    HAVE             : dsh_HAVE,
+    HAVE_RESPONSE    : dsh_HAVE_RESPONSE,
     REQUEST_PART     : dsh_REQUEST_PART,
+    REQUEST_RANGE    : dsh_REQUEST_RANGE,
     SEND_PART        : dsh_SEND_PART,
+    STATS            : dsh_STATS,
+    STATS_RESPONSE   : dsh_STATS_RESPONSE,
     ERROR            : dsh_ERROR,
+    TRANSFER_ERROR   : dsh_TRANSFER_ERROR,
     DISABLED         : dsh_DISABLED,
   }
 
@@ -231,7 +1020,27 @@ class DshProtocol(protocol.Protocol):
     Override to implement error handling, default is to log and loose connection.
     """
     log.msg("dsh_error: %s" % (message))
-    self.transport.loseConnection()
+    self.loseConnection()
+
+  def dsh_transfer_error(self, uid, path, message):
+    """
+    The peer failed transfer 'uid' of 'path', which is dropped on this side
+    too; every other transfer carries on. Transfers already dropped here
+    have been failed already.
+    """
+    log.msg("dsh_transfer_error: %s: %s" % (path, message))
+
+    if uid in self._dropped:
+      return
+
+    self.dropTransfer(uid)
+    self.transferFailed(uid, path, message)
+
+  def transferFailed(self, uid, path, message):
+    """
+    Override to handle a failed transfer of 'path', 'uid' is None if it
+    failed before it was started.
+    """
 
   def dsh_disabled(self, message):
     """
@@ -243,142 +1052,527 @@ class DshProtocol(protocol.Protocol):
     """
     Override to handle part request.
     """
+    if uid in self._dropped:
+      return
+
     if uid not in self._send:
       self.error("no transfer in progress")
       return
 
     uid, path, generator = self._send.get(uid)
 
-    try:
-      data = generator.read(count)
-      self.send_part(uid, count, data)
-    except Exception, e:
-      import sys
-      self.error("internal error: " + str(e))
-      exc = sys.exc_info()
-      raise exc[1], None, exc[2]
+    if count >= generator.parts():
+      self.error("part out of bounds")
+      return
+
+    self._producer.queue(uid, count)
+
+  def transferWeight(self, uid):
+    """
+    Override to weigh transfers, the number of parts of transfer 'uid' sent
+    in each round before the other transfers get their turn.
+    """
+    return 1
+
+  def producePart(self, uid, count):
+    """
+    Read and send a queued part, called by the producer once the transport
+    has room for it. Returns a Deferred which fires once the part has been
+    sent, or None if there is nothing to send.
+    """
+    if uid not in self._send:
+      return None
+
+    uid, path, generator = self._send.get(uid)
+
+    d = self.storage.run(self.encodePart, uid, generator, count)
+    d.addCallbacks(self._readPart, self._readFailed,
+        callbackArgs=(uid, count), errbackArgs=(uid, count))
+    return d
+
+  def readPart(self, generator, count):
+    """
+    Read part 'count' and compute its digest, called from the storage pool so
+    that neither reading nor hashing the part blocks the reactor.
+    """
+    data = self.profiler.timed(generator.read)(count)
+    return data, self.partDigest(data)
+
+  def encodePart(self, uid, generator, count):
+    """
+    Read part 'count' of transfer 'uid' and compress it if compression was
+    agreed, called from the storage pool. Returns the size of the part, its
+    digest, the payload to send and its flags.
+    """
+    data, digest = self.readPart(generator, count)
+    payload, flags = data, 0
+
+    if self.compressName is not None:
+      payload, flags = self.profiler.timed(self.compress)(uid, data)
+
+    return len(data), digest, payload, flags
+
+  def _readPart(self, result, uid, count):
+    size, digest, data, flags = result
+
+    if self.connected and uid in self._send:
+      self.metrics.sent(uid, size)
+      self.send_part(uid, count, data, digest, flags)
+
+  def _readFailed(self, failure, uid, count):
+    log.err(failure, "cannot read part %d" % (count))
+
+    if self.connected and uid in self._send:
+      path = self._send[uid][1]
+      self.abortTransfer(uid, path, "cannot read part %d: %s" % (count, failure.getErrorMessage()))
+
+  def dsh_request_range(self, uid, start, count):
+    """
+    Override to handle range request, by default each part in the range is
+    handled as a separate part request.
+    """
+    if uid in self._dropped:
+      return
+
+    if uid not in self._send:
+      self.error("no transfer in progress")
+      return
+
+    uid, path, generator = self._send.get(uid)
+
+    if start + count > generator.parts():
+      self.error("range out of bounds")
+      return
+
+    for i in xrange(start, start + count):
+      self.dsh_request_part(uid, i)
+
+  def hello(self):
+    data = bencode.bencode({
+      "digests": [n for n in self.digestNames if n in self.digests],
+      "compressors": [n for n in self.compressNames if n in self.compressors],
+      "features": self.features(),
+    })
+    self.sendFrame(self.HELLO, info=(self.VERSION, self.partSize), data=data)
 
   def get(self, path):
     self.sendFrame(self.GET, data=path)
 
-  def get_response(self, uid, size, path):
-    self.sendFrame(self.GET_RESPONSE, info=(uid, size), data=path)
+  def get_response(self, uid, size, path, version):
+    self.sendFrame(self.GET_RESPONSE, info=(uid, size, version), data=path)
 
-  def put(self, uid, size, path):
-    self.sendFrame(self.PUT, info=(uid, size), data=path)
+  def put(self, uid, size, path, version):
+    self.sendFrame(self.PUT, info=(uid, size, version), data=path)
     return uid
 
   def request_part(self, uid, count):
     self.sendFrame(self.REQUEST_PART, info=(uid, count))
 
-  def send_part(self, uid, count, data):
-    if self.checkDigest:
-      digest = self.digestFunction(data)
-    else:
-      digest = "\x00" * self.digestSize
+  def request_range(self, uid, start, count):
+    self.sendFrame(self.REQUEST_RANGE, info=(uid, start, count))
 
-    self.sendFrame(self.SEND_PART, info=(uid, count, digest), data=data)
+  def send_part(self, uid, count, data, digest, flags=0):
+    self.sendFrame(self.SEND_PART, info=(uid, count, flags, digest), data=data)
+
+  def compress(self, uid, data):
+    """
+    Compress a part of transfer 'uid' if that makes it smaller, returns the
+    payload to send and its flags. Called from the storage pool.
+    """
+    skip = self._skip.get(uid, 0)
+
+    if skip > 0:
+      self._skip[uid] = skip - 1
+      return data, 0
+
+    compressed = self.compressors[self.compressName][0](data)
+
+    if len(compressed) > len(data) * self.compressRatio:
+      self._skip[uid] = self.compressSkip
+      return data, 0
+
+    return compressed, self.COMPRESSED
+
+  def decompress(self, data):
+    if self.compressName is None:
+      raise ValueError, "compression not agreed"
+
+    data = self.compressors[self.compressName][1](str(data), self.partSize + 1)
+
+    if len(data) > self.partSize:
+      raise ValueError, "decompressed part too large"
+
+    return data
+
+  def bundle(self, uid, size, base, package):
+    data = bencode.bencode({"base": base, "package": package.dump()})
+    self.sendFrame(self.BUNDLE, info=(uid, size), data=data)
+
+  def have(self, uid, hashes):
+    """
+    Ask which of the chunks with the given concatenated SHA1s are present,
+    before putting transfer 'uid'.
+    """
+    step = self.DATA_MAX / 20 * 20
+
+    for start in xrange(0, len(hashes), step):
+      self.sendFrame(self.HAVE, info=(uid, start / 20), data=hashes[start:start + step])
+
+  def have_response(self, uid, start, bitmap):
+    self.sendFrame(self.HAVE_RESPONSE, info=(uid, start), data=bitmap)
+
+  def sync(self, uid, size, base, meta, version):
+    """
+    Send the SHA1s of the manifest in SYNC_HASHES frames of at most DATA_MAX
+    bytes, then the SYNC with the rest of the manifest.
+    """
+    step = self.DATA_MAX / 20 * 20
+
+    for start in xrange(0, len(meta.hashes), step):
+      self.sendFrame(self.SYNC_HASHES, info=(uid, start / 20), data=meta.hashes[start:start + step])
+
+    h = meta.dump()
+    h["hashes"] = ""
+    data = bencode.bencode({"base": base, "file": h})
+    self.sendFrame(self.SYNC, info=(uid, size, version), data=data)
 
   def put_ack(self, uid):
     self.sendFrame(self.PUT_ACK, info=(uid,))
 
-  def _feeder(self):
-    while True:
-      c = yield 1
+  def stats(self):
+    self.sendFrame(self.STATS)
 
-      if not str(c) in self.commands:
-        self.error("no such command")
-        return
+  def stats_response(self, data):
+    self.sendFrame(self.STATS_RESPONSE, data=data)
 
-      st = self.frames.get(c)
-      
-      res = yield st.size
-      infodata = st.unpack(res)
+  def frameStruct(self, c):
+    """
+    Return the struct for the header of command 'c', or None if the command is
+    not acceptable.
+    """
+    if not c in self.commands:
+      self.error("no such command")
+      return None
 
-      data_size, info = infodata[0], infodata[1:]
+    if not self.ready and c not in self.handshake:
+      self.error("handshake required")
+      return None
 
-      if data_size > self.DATA_MAX:
-        self.error("data_size greater than DATA_MAX")
-        return
+    return self.frames.get(c)
 
-      if data_size > 0:
-        data = yield data_size
-      else:
-        data = None
+  def frameSize(self, data_size):
+    if data_size > max(self.DATA_MAX, self.partSize):
+      self.error("data_size greater than DATA_MAX")
+      return False
+
+    return True
+
+  def frameReceived(self, c, info, data):
+    fn = self.functions.get(c)
 
-      fn = self.functions.get(c)
+    if self.logFrames:
       log.msg("R:%s" % (fn.func_name))
-      fn(self, info, data)
+
+    self.profiler.timed(fn)(self, info, data)
 
   def sendFrame(self, c, info=tuple(), data=""):
     if c not in self.commands:
       raise RuntimeError, "not a command %s" % (repr(c))
-    fn = self.functions.get(c)
 
-    log.msg("S:%s" % (fn.func_name))
+    if self.logFrames:
+      log.msg("S:%s" % (self.functions.get(c).func_name))
+
+    if not isinstance(data, str):
+      data = str(data)
 
     st = self.frames.get(c)
-    self.transport.write(c)
-    self.transport.write(st.pack(len(data), *info))
-    if data != "":
-      self.transport.write(data)
+    header = c + st.pack(len(data), *info)
 
-  def putFile(self, path):
-    generator = self.buildGenerator(path)
+    if len(data) <= self.coalesceMax:
+      self._pending.append(header)
 
-    if not IGenerator.providedBy(generator):
-      log.msg("invalid generator: %s" % (repr(generator)))
-      self.error("invalid generator")
+      if data:
+        self._pending.append(data)
+
+      if self._flush is None:
+        self._flush = reactor.callLater(0, self._flushed)
+
+      return
+
+    pending = self._pending
+    self._pending = []
+    pending.append(header)
+    pending.append(data)
+    self.transport.writeSequence(pending)
+
+  def _flushed(self):
+    self._flush = None
+    self.flushFrames()
+
+  def flushFrames(self):
+    """
+    Write the frames held back by sendFrame.
+    """
+    if not self._pending:
       return
 
+    data = "".join(self._pending)
+    self._pending = []
+    self.transport.write(data)
+
+  def loseConnection(self):
+    """
+    Write any held back frames and close the connection.
+    """
+    self.flushFrames()
+    self.transport.loseConnection()
+
+  def putFile(self, path, hashes=None):
+    """
+    Put the file at 'path', if the SHA1s of its 1 MiB chunks are given in
+    'hashes' the chunks which the peer already has are not sent. Returns the
+    uid of the transfer, or None if it failed to start.
+    """
+    try:
+      generator = self.openGenerator(path)
+    except Exception, e:
+      self.abortTransfer(None, path, "cannot put: " + str(e))
+      return None
+
     uid = self.generateUuid()
     self._send[uid] = (uid, path, generator)
     size  = generator.size()
-    self.put(uid, size, path)
+    self.metrics.start(uid, "send", path, size)
+
+    if hashes and "have" in self.peerFeatures:
+      self.have(uid, hashes)
+
+    return self.put(uid, size, path, self.sourceVersion(generator))
+
+  def syncFile(self, base, meta, path):
+    try:
+      generator = self.openGenerator(path)
+    except Exception, e:
+      self.abortTransfer(None, path, "cannot sync: " + str(e))
+      return
+
+    uid = self.generateUuid()
+    self._send[uid] = (uid, path, generator)
+    self.metrics.start(uid, "send", path, generator.size())
+    self.sync(uid, generator.size(), base, meta, self.sourceVersion(generator))
+
+  def putBundle(self, base, files):
+    """
+    Put the File's in 'files', all below 'base', as a single transfer.
+    """
+    try:
+      package = MetaPackage([FileMeta(f.path, f.get_size(), "") for f in files])
+      generator = self.buildBundleGenerator(base, package)
 
-  def recvFile(self, uid, size, path):
+      if not IGenerator.providedBy(generator):
+        raise TypeError, "invalid generator: %s" % (repr(generator))
+    except Exception, e:
+      self.abortTransfer(None, base, "cannot bundle: " + str(e))
+      return
+
+    uid = self.generateUuid()
+    self._send[uid] = (uid, base, generator)
+    self.metrics.start(uid, "send", base, generator.size())
+    self.bundle(uid, generator.size(), base, package)
+
+  def openGenerator(self, path):
+    """
+    Build the generator for 'path', raises if it cannot be read.
+    """
+    generator = self.buildGenerator(path)
+
+    if not IGenerator.providedBy(generator):
+      raise TypeError, "invalid generator: %s" % (repr(generator))
+
+    return generator
+
+  def abortTransfer(self, uid, path, message):
+    """
+    Fail transfer 'uid' of 'path' on this side: drop it, tell the peer with a
+    TRANSFER_ERROR unless it never heard of it, and call transferFailed.
+    """
+    log.msg("ERROR: %s: %s" % (path, message))
+
+    if uid is not None:
+      self.dropTransfer(uid)
+
+      if self.connected:
+        self.transfer_error(uid, path, message)
+
+    self.transferFailed(uid, path, message)
+
+  def dropTransfer(self, uid):
+    """
+    Stop sending or receiving transfer 'uid', frames for it which are still
+    on their way are ignored.
+    """
+    self._dropped.add(uid)
+    self._have.pop(uid, None)
+    self._syncHashes.pop(uid, None)
+
+    if uid in self._send:
+      uid, path, generator = self._send.pop(uid)
+      generator.close()
+      self._producer.cancel(uid)
+      self._skip.pop(uid, None)
+      self.metrics.finish(uid, "send", False)
+
+    if uid in self._recv:
+      recv, writer, inflight = self._recv.pop(uid)
+      self.metrics.finish(uid, "recv", False)
+      d = self.closeWriter(recv, writer)
+      d.addErrback(log.err, "cannot close %s" % (recv.path))
+
+  def recvFile(self, uid, size, path, have=None, version=None):
     if uid in self._recv:
       raise RuntimeError, "transfer already active"
 
-    writer = self.buildWriter(path, size)
-    self._recv[uid] = ([False] * writer.parts(), writer)
+    recv = self.loadState(uid, path, size, version)
+
+    if recv is not None:
+      log.msg("resuming %s, %d parts missing" % (path, recv.parts.missing()))
+
+    writer = self.buildWriter(path, size, resume=recv is not None or have is not None)
+
+    try:
+      if recv is None:
+        recv = ReceiveState(uid, path, size, writer.parts(), self.digestSize)
+
+        for count, digest in have or ():
+          writer.keep(count, digest)
+
+          if self.digestName != "sha1":
+            digest = "\x00" * self.digestSize
+
+          recv.add(count, digest)
+    except:
+      writer.close()
+      raise
+
+    recv.version = version
+    self._recv[uid] = (recv, writer, dict())
+    self.metrics.start(uid, "recv", path, size)
     return self._recv[uid]
 
+  def requestParts(self, uid):
+    """
+    Start requesting the missing parts of transfer 'uid', or complete it right
+    away if nothing is missing.
+    """
+    if self.fillWindow(uid):
+      return
+
+    recv, writer, inflight = self._recv.pop(uid)
+    self.completeTransfer(uid, recv, writer)
+
+  def fillWindow(self, uid):
+    """
+    Request missing parts of transfer 'uid' once at least windowRefill slots of
+    the window are free, returns False if every part has been received.
+    """
+    recv, writer, inflight = self._recv[uid]
+
+    if recv.complete():
+      return False
+
+    free = self.windowSize - len(inflight)
+
+    if inflight and free < self.windowRefill:
+      return True
+
+    now = time.time()
+
+    for start, count in recv.take(free):
+      inflight.update(dict.fromkeys(xrange(start, start + count), now))
+
+      if count == 1:
+        self.request_part(uid, start)
+      else:
+        self.request_range(uid, start, count)
+
+    return True
+
   def error(self, message):
     log.msg("ERROR: " + message)
     self.sendFrame(self.ERROR, data=message)
 
+  def transfer_error(self, uid, path, message):
+    data = bencode.bencode({"path": path, "message": message})
+    self.sendFrame(self.TRANSFER_ERROR, info=(uid,), data=data)
+
   def disabled(self, message):
     self.sendFrame(self.DISABLED, data=message)
 
   def makeConnection(self, transport):
-    self._feeder = self._feeder()
-    self._required = self._feeder.next()
-    self._buffer = bytearray(self.READ_MAX)
-    self._p = 0
-    self._received = 0
+    self._decoder = FrameDecoder(self, self.bufferPool)
 
     self._send = dict()
     self._recv = dict()
+    self._dropped = set()
+    self._producer = PartProducer(self)
+    transport.registerProducer(self._producer, True)
+
+    self._skip = dict()
+    self._pending = []
+    self._flush = None
+    self._paused = set()
+
+    self.ready = False
+    self.compressName = None
+    self.peerFeatures = set()
+    self._have = dict()
+    self._syncHashes = dict()
+    self.transport = transport
+    self.hello()
     protocol.Protocol.makeConnection(self, transport)
 
-  def dataReceived(self, data):
-    self._received += len(data)
+  def connectionLost(self, reason):
+    self.connected = 0
 
-    while self._received >= self._required:
-      data_part = self._required - self._p
+    for uid, (recv, writer, inflight) in self._recv.items():
+      self.metrics.finish(uid, "recv", False)
+      d = self.closeWriter(recv, writer)
+      d.addErrback(log.err, "cannot close %s" % (recv.path))
 
-      if self._p == 0:
-        feed = data[0:data_part]
-      else:
-        feed = self._buffer[0:self._p] + data[0:data_part]
+    self._recv.clear()
 
-      rest = data[data_part:]
+    for uid, path, generator in self._send.values():
+      self.metrics.finish(uid, "send", False)
+      generator.close()
 
-      self._received -= len(feed)
-      self._required = self._feeder.send(feed)
-      data = rest
-      self._p = 0
+    self._send.clear()
+    self._decoder.close()
 
-    self._buffer[self._p:self._p + len(data)] = data
-    self._p += len(data)
+    if self._flush is not None and self._flush.active():
+      self._flush.cancel()
+
+    self._flush = None
+    self._pending = []
+    protocol.Protocol.connectionLost(self, reason)
+
+  def pauseReading(self, reason):
+    """
+    Stop reading from the transport until resumeReading is called with the
+    same 'reason'.
+    """
+    if not self._paused:
+      self.transport.pauseProducing()
+
+    self._paused.add(reason)
+
+  def resumeReading(self, reason):
+    if reason not in self._paused:
+      return
+
+    self._paused.discard(reason)
+
+    if not self._paused:
+      self.transport.resumeProducing()
+
+  def dataReceived(self, data):
+    self._decoder.feed(data)
@@ -1,42 +1,97 @@
+import contextlib
 import hashlib
 import os
+import multiprocessing
+import multiprocessing.pool
+import threading
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 import bencode
 import uuid
 
+from .descriptors import SharedFile
+
 encode = bencode.bencode
 decode = bencode.bdecode
 hashDigest = lambda s: hashlib.sha1(s).digest()
 generateUuid = lambda: uuid.uuid4().bytes
 
+@contextlib.contextmanager
+def locked(path):
+  """
+  Hold an exclusive lock on the file 'path', which is created if needed, so
+  that processes sharing a file take turns updating it.
+  """
+  fp = open(path, "a")
+
+  try:
+    if fcntl is not None:
+      fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+
+    yield
+  finally:
+    fp.close()
+
 class FileVerif:
   """
   File verification class, which associates a File to a MetaFile and is able to
   perform detailed checking.
   """
-  def __init__(self, f, m):
+  def __init__(self, f, m, cache=None, workers=1):
     """
-    Verify file 'f' against meta 'm'
+    Verify file 'f' against meta 'm', optionally using HashCache 'cache' and
+    hashing chunks on 'workers' threads.
     """
     self.f = f
     self.fm = None
     self.m = m
+    self.cache = cache
+    self.workers = workers
     self.ok_size   = None
     self.ok_hashes = None
 
   def update(self):
-    self.ok_size    = self.ok_size or m.size == self.f.get_size()
-    z = zip(self.ok_hashes, xrange(len(self.ok_hashes)))
-    self.ok_hashes  = [ok_hash or self.m.get_hash(i) == self.f.hashdigest_one(i) for ok_hash, i in z]
+    """
+    Check the file again, only chunks which are still bad are re-hashed.
+    """
+    self.ok_size = self.m.size == self.f.get_size()
+    self.check([i for i, ok in enumerate(self.ok_hashes) if not ok])
 
-  def create(self):
+  def create(self, chunks=False):
+    """
+    Check the file, stops early if the sizes differ unless 'chunks' is set in
+    which case the chunks which the two have in common are still compared.
+    """
     self.ok_size = self.m.size == self.f.get_size()
-    self.fm = self.f.metadigest()
+    self.ok_hashes = [False] * self.m.hashsize
+
+    if not self.ok_size and not chunks:
+      return
+
+    if self.cache is None:
+      self.check(xrange(self.m.hashsize))
+      return
+
+    self.fm = self.f.metadigest(self.cache)
     a = self.fm.get_hash
     b = self.m.get_hash
 
-    if self.fm.hashsize == self.m.hashsize:
-      self.ok_hashes  = [a(i) == b(i) for i in xrange(self.m.hashsize)]
+    n = min(self.fm.hashsize, self.m.hashsize)
+    self.ok_hashes  = [i < n and a(i) == b(i) for i in xrange(self.m.hashsize)]
+
+  def check(self, indexes):
+    """
+    Hash the chunks 'indexes' of the file and compare them to the meta.
+    """
+    indexes = list(indexes)
+    hashes = self.f.hashdigest_many(indexes, self.workers)
+
+    for i, h in zip(indexes, hashes):
+      self.ok_hashes[i] = h is not None and h == self.m.get_hash(i)
 
   def all_ok(self):
     return self.ok_size and all(self.ok_hashes)
@@ -82,10 +137,21 @@ class File:
     self.base = base
     self.path = path
 
-  def metadigest(self):
+  def metadigest(self, cache=None):
+    if cache is not None:
+      stamp = cache.stamp(self)
+      meta = cache.get(self, stamp)
+      if meta is not None:
+        return meta
+
     size = self.get_size()
     hashes = "".join((h for h in self.hashdigest_all()))
-    return FileMeta(self.path, size, hashes)
+    meta = FileMeta(self.path, size, hashes)
+
+    if cache is not None:
+      cache.put(self, stamp, meta)
+
+    return meta
 
   def hashdigest_all(self):
     fp = open(self.get_path(), "r")
@@ -108,15 +174,67 @@ class File:
     finally:
       fp.close()
 
+  def hashdigest_many(self, indexes, workers=1):
+    """
+    Hash the chunks 'indexes' from a single open file, on 'workers' threads.
+    Chunks past the end of the file hash to None.
+    """
+    f = SharedFile(self.get_path())
+
+    def one(i):
+      pos = self.CHUNK_SIZE * i
+      if pos >= f.size: return None
+      return hashDigest(f.read(pos, self.CHUNK_SIZE))
+
+    try:
+      if workers <= 1:
+        return [one(i) for i in indexes]
+
+      pool = multiprocessing.pool.ThreadPool(workers)
+
+      try:
+        return pool.map(one, indexes)
+      finally:
+        pool.close()
+        pool.join()
+    finally:
+      f.close()
+
+  def hashdigest_range(self, i, n):
+    """
+    Hash 'n' chunks starting at chunk 'i', returns the concatenated hashes.
+    """
+    fp = open(self.get_path(), "r")
+
+    try:
+      fp.seek(self.CHUNK_SIZE * i)
+      hashes = []
+
+      for j in xrange(n):
+        part = fp.read(self.CHUNK_SIZE)
+        if not part: break
+        hashes.append(hashDigest(part))
+
+      return "".join(hashes)
+    finally:
+      fp.close()
+
+  def chunks(self, size=None):
+    if size is None:
+      size = self.get_size()
+    chunks, mod = divmod(size, self.CHUNK_SIZE)
+    if mod != 0: chunks += 1
+    return chunks
+
   def get_size(self):
     return os.path.getsize(self.get_path())
   
-  def verify(self, meta):
+  def verify(self, meta, cache=None, chunks=False, workers=1):
     if not os.path.isfile(self.get_path()):
       raise RuntimeError, "no such file"
 
-    verif = FileVerif(self, meta)
-    verif.create()
+    verif = FileVerif(self, meta, cache, workers)
+    verif.create(chunks)
     return verif
 
   def isfile(self):
@@ -145,6 +263,218 @@ class File:
     for p, real in generator():
       yield klass(base, *p)
 
+class Hasher:
+  """
+  Builds FileMeta for many files at once, spreading the chunks of every file
+  over a pool of worker threads. hashlib releases the GIL while hashing, so
+  this scales over cores while producing the same hashes as
+  File.metadigest.
+  """
+  BATCH_CHUNKS = 16
+
+  def __init__(self, workers=None, cache=None):
+    if workers is None:
+      workers = multiprocessing.cpu_count()
+
+    self.workers = workers
+    self.cache = cache
+
+  def metadigest(self, f):
+    return self.metadigest_all([f])[0]
+
+  def metadigest_all(self, files):
+    files = list(files)
+    metas = [None] * len(files)
+    stamps = [None] * len(files)
+
+    if self.cache is not None:
+      for n, f in enumerate(files):
+        stamps[n] = self.cache.stamp(f)
+        metas[n] = self.cache.get(f, stamps[n])
+
+    missing = [n for n, meta in enumerate(metas) if meta is None]
+
+    for n, meta in zip(missing, self._hash([files[n] for n in missing])):
+      metas[n] = meta
+
+      if self.cache is not None:
+        self.cache.put(files[n], stamps[n], meta)
+
+    return metas
+
+  def _hash(self, files):
+    sizes = [f.get_size() for f in files]
+    tasks = list()
+
+    for n, (f, size) in enumerate(zip(files, sizes)):
+      chunks = f.chunks(size)
+
+      for i in xrange(0, chunks, self.BATCH_CHUNKS):
+        tasks.append((n, f, i, min(self.BATCH_CHUNKS, chunks - i)))
+
+    hashes = [[] for f in files]
+
+    if self.workers <= 1:
+      results = (f.hashdigest_range(i, c) for n, f, i, c in tasks)
+      for (n, f, i, c), h in zip(tasks, results):
+        hashes[n].append(h)
+    else:
+      pool = multiprocessing.pool.ThreadPool(self.workers)
+
+      try:
+        results = pool.imap(lambda t: t[1].hashdigest_range(t[2], t[3]), tasks)
+        for (n, f, i, c), h in zip(tasks, results):
+          hashes[n].append(h)
+      finally:
+        pool.close()
+        pool.join()
+
+    return [FileMeta(f.path, size, "".join(h)) for f, size, h in zip(files, sizes, hashes)]
+
+class HashCache:
+  """
+  On-disk cache of FileMeta, so that unchanged files do not have to be hashed
+  again. Entries are keyed by path and only valid while the device, inode,
+  size and modification time of the file are unchanged; the least recently
+  used entries are evicted once the hashes stored exceed 'max_bytes'.
+
+  Several processes may share the cache file, entries saved by the others
+  are merged in on save. Files are verified from storage threads, so the
+  entries are only touched under a lock.
+  """
+  MAX_BYTES = 64 * 2 ** 20
+
+  def __init__(self, path, max_bytes=MAX_BYTES):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.entries = dict()
+    self.size = 0
+    self.tick = 0
+    self.dirty = False
+    self._lock = threading.Lock()
+
+    if os.path.isfile(path):
+      self.load()
+
+  def key(self, f):
+    return os.path.abspath(f.get_path())
+
+  def stamp(self, f):
+    """
+    Return the identity of the file as it is right now, to be given to get
+    and put.
+    """
+    try:
+      st = os.stat(f.get_path())
+    except OSError, e:
+      return None
+
+    return [st.st_dev, st.st_ino, st.st_size, int(st.st_mtime * 10 ** 9)]
+
+  def get(self, f, stamp):
+    key = self.key(f)
+
+    with self._lock:
+      entry = self.entries.get(key)
+
+      if entry is None or stamp is None:
+        return None
+
+      if entry["stamp"] != stamp:
+        self.invalidate(key)
+        return None
+
+      self.tick += 1
+      entry["used"] = self.tick
+      return FileMeta(f.path, entry["size"], entry["hashes"])
+
+  def put(self, f, stamp, meta):
+    if stamp is None:
+      return
+
+    key = self.key(f)
+
+    with self._lock:
+      self.invalidate(key)
+      self.tick += 1
+      self.entries[key] = {
+        "stamp": stamp,
+        "size": meta.size,
+        "hashes": meta.hashes,
+        "used": self.tick,
+      }
+      self.size += len(key) + len(meta.hashes)
+      self.dirty = True
+      self.evict()
+
+  def invalidate(self, key):
+    """
+    Drop the entry for 'key', the caller holds the lock.
+    """
+    entry = self.entries.pop(key, None)
+
+    if entry is not None:
+      self.size -= len(key) + len(entry["hashes"])
+      self.dirty = True
+
+  def evict(self):
+    """
+    Drop the least recently used entries, the caller holds the lock.
+    """
+    if self.size <= self.max_bytes:
+      return
+
+    for key, entry in sorted(self.entries.items(), key=lambda e: e[1]["used"]):
+      if self.size <= self.max_bytes:
+        break
+      self.invalidate(key)
+
+  def read(self):
+    fp = open(self.path, "rb")
+
+    try:
+      return decode(fp.read()).get("entries", dict())
+    finally:
+      fp.close()
+
+  def load(self, entries=None):
+    if entries is None:
+      entries = self.read()
+
+    self.entries = dict()
+    self.size = 0
+
+    for key, entry in entries.items():
+      self.entries[key] = entry
+      self.size += len(key) + len(entry["hashes"])
+
+    self.tick = max([e["used"] for e in self.entries.values()] or [0])
+    self.dirty = False
+
+  def save(self):
+    if not self.dirty:
+      return
+
+    with self._lock, locked(self.path + ".lock"):
+      entries = dict()
+
+      if os.path.isfile(self.path):
+        entries = self.read()
+
+      entries.update(self.entries)
+      self.load(entries)
+      self.evict()
+
+      fp = open(self.path + ".tmp", "wb")
+
+      try:
+        fp.write(encode({"entries": self.entries}))
+      finally:
+        fp.close()
+
+      os.rename(self.path + ".tmp", self.path)
+      self.dirty = False
+
 class MetaPackage:
   def __init__(self, files, uuid=None):
     self.files = files
@@ -175,12 +505,12 @@ class MetaPackage:
 
 if __name__ == "__main__":
   files = list(File.opendir("."))
-  package = MetaPackage([f.metadigest() for f in files])
+  package = MetaPackage(Hasher().metadigest_all(files))
   s = package.dumps()
 
   package = MetaPackage.loads(s)
 
-  metas = [f.metadigest() for f in files]
+  metas = package.files
 
   #for meta, f in zip(metas, files):
     #verif = f.verify(meta)
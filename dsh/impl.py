@@ -1,4 +1,22 @@
+import os
+import sys
+import yaml
+import bisect
+import threading
+import collections
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from twisted.internet import protocol
+from twisted.python import log
+
 from .dsh import DshProtocol
+from .file import File, MetaPackage, Hasher
+from .cache import cache
+from .chunks import ChunkWriter, ChunkGenerator
 
 class DshServerProtocol(DshProtocol):
   """
@@ -6,108 +24,590 @@ class DshServerProtocol(DshProtocol):
   """
   enableGetFile = True
   enablePutFile = True
+  enableSyncFile = True
+  enableStats = True
+
+  """
+  Cache of served parts and their digests, shared by all connections.
+  """
+  partCache = cache
 
   def __init__(self):
     self._files = dict()
 
+  def chunkStore(self):
+    """
+    The ChunkStore files are kept in instead of as flat files, if the factory
+    has one.
+    """
+    return getattr(getattr(self, "factory", None), "chunkStore", None)
+
+  def features(self):
+    """
+    HAVE queries are answered with a chunk store, bundles are unpacked into
+    flat files and so only accepted without one.
+    """
+    if self.chunkStore() is not None:
+      return ["have"]
+
+    return ["bundle"]
+
+  def statistics(self):
+    stats = DshProtocol.statistics(self)
+    stats["pid"] = os.getpid()
+    stats["part_cache"] = {
+      "hits": self.partCache.hits,
+      "misses": self.partCache.misses,
+      "bytes": self.partCache.size,
+    }
+    stats["buffers"] = {
+      "leased": self.bufferPool.leased,
+      "kept": self.bufferPool.kept,
+    }
+    return stats
+
+  def findChunks(self, digests):
+    store = self.chunkStore()
+
+    if store is None:
+      return DshProtocol.findChunks(self, digests)
+
+    return [store.has(digest) for digest in digests]
+
   def buildGenerator(self, path):
-    return FileGenerator(path)
+    store = self.chunkStore()
+
+    if store is not None:
+      return ChunkGenerator(store, path, self.partSize)
+
+    return FileGenerator(path, self.partSize)
+
+  def readPart(self, generator, count):
+    """
+    Serve parts of unchanged files from the part cache, without reading or
+    hashing them again.
+    """
+    f = generator.key()
+    part = (count, self.partSize, self.checkDigest and self.digestName or None)
+    entry = self.partCache.get(f, part)
+
+    if entry is not None:
+      return entry
+
+    data, digest = DshProtocol.readPart(self, generator, count)
+    data = str(data)
+    self.partCache.put(f, part, data, digest)
+    return data, digest
+
+  def checkPath(self, meta):
+    if any(p in ("", ".", "..") for p in meta.path):
+      raise ValueError, "invalid path"
+
+  def compareFile(self, base, meta):
+    self.checkPath(meta)
+
+    f = meta.tofile(base)
+    path = f.get_path()
+    store = self.chunkStore()
+
+    if store is not None:
+      hashes = [(i, meta.get_hash(i)) for i in xrange(meta.hashsize)]
+      return path, [(i, h) for i, h in hashes if store.has(h)]
+
+    if not f.isfile():
+      directory = os.path.dirname(path)
+
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+      return path, []
+
+    verif = f.verify(meta, getattr(self.factory, "hashCache", None), chunks=True)
+    have = [(i, meta.get_hash(i)) for i, ok in enumerate(verif.ok_hashes) if ok]
+    return path, have
+
+  def buildWriter(self, path, size, resume=False):
+    store = self.chunkStore()
 
-  def buildWriter(self, path, size):
-    writer = FileWriter()
-    writer.open(path, size)
+    if store is not None:
+      writer = ChunkWriter(store, self.partSize)
+      writer.open(path, size)
+      return writer
+
+    writer = FileWriter(self.partSize, self.syncParts)
+    writer.open(path, size, populate=self.preallocate, resume=resume)
+    return writer
+
+  def recvFile(self, uid, size, path, have=None, version=None):
+    """
+    Files received into a chunk store are not resumed from saved state, the
+    chunks they already wrote are found by HAVE and SYNC instead.
+    """
+    transfer = DshProtocol.recvFile(self, uid, size, path, have, version)
+
+    if self.chunkStore() is not None:
+      transfer[0].resumable = False
+
+    return transfer
+
+  def loadState(self, uid, path, size, version=None):
+    if self.chunkStore() is not None:
+      return None
+
+    return DshProtocol.loadState(self, uid, path, size, version)
+
+  def buildBundleWriter(self, base, package, size):
+    if self.chunkStore() is not None:
+      raise IOError, "bundles cannot be stored in a chunk store"
+
+    for meta in package.files:
+      self.checkPath(meta)
+
+    writer = BundleWriter(base, package, self.partSize)
+    writer.open(base, size)
     return writer
 
 class DshClientPutProtocol(DshProtocol):
   """
-  The default client protocol.
+  The default client protocol, puts every given path over one connection,
+  concurrentTransfers at a time. Small files are put in bundles if the
+  server accepts them, the others are hashed first when the server can tell
+  which of their chunks it has.
   """
-  def __init__(self, path):
-    self.path = path
+  def __init__(self, *paths):
+    self.paths = collections.deque(paths)
+    self.bundles = collections.deque()
+    self.hashing = 0
+    self.failed = 0
+
+  def connectionReady(self):
+    if "bundle" in self.peerFeatures:
+      self.makeBundles()
+
+    self.putNext()
+
+  def makeBundles(self):
+    """
+    Move files of at most bundleFileMax bytes from the paths into bundles,
+    each bundle holds files below the same base. Bundles are only ever put,
+    the server never bundles files it sends.
+    """
+    paths = collections.deque()
+    pending = dict()
+    maxSize = self.bundleParts * self.partSize
+
+    for path in self.paths:
+      base = path.startswith(os.sep) and os.sep or ""
+      f = File(base, *os.path.normpath(path).lstrip(os.sep).split(os.sep))
+
+      if any(p in ("", ".", "..") for p in f.path) or not f.isfile():
+        paths.append(path)
+        continue
+
+      size = f.get_size()
+
+      if size > self.bundleFileMax:
+        paths.append(path)
+        continue
+
+      files, total = pending.get(base, ([], 0))
+
+      if len(files) >= self.bundleFiles or total + size > maxSize:
+        self.bundles.append((base, files))
+        files, total = [], 0
+
+      files.append(f)
+      pending[base] = (files, total + size)
+
+    self.bundles.extend((base, files) for base, (files, total) in pending.items())
+
+    for base, files in list(self.bundles):
+      if len(files) == 1:
+        self.bundles.remove((base, files))
+        paths.append(files[0].get_path())
+
+    self.paths = paths
+
+  def putNext(self):
+    while len(self._send) + self.hashing < self.concurrentTransfers:
+      if self.bundles:
+        self.putBundle(*self.bundles.popleft())
+      elif self.paths:
+        self.putPath(self.paths.popleft())
+      else:
+        break
+
+    if not self._send and not self.hashing:
+      self.loseConnection()
+
+  def putPath(self, path):
+    if "have" not in self.peerFeatures or not os.path.isfile(path):
+      self.putFile(path)
+      return
+
+    self.hashing += 1
+
+    f = File(os.path.dirname(path), os.path.basename(path))
+    d = self.storage.run(f.metadigest)
+    d.addCallback(lambda meta: meta.hashes)
+    d.addErrback(log.err, "cannot hash %s" % (path))
+    d.addCallback(self.hashed, path)
 
-  def connectionMade(self):
-    self.putFile(self.path)
+  def hashed(self, hashes, path):
+    self.hashing -= 1
+
+    if self.connected:
+      self.putFile(path, hashes)
+      self.putNext()
 
   def buildGenerator(self, path):
-    return FileGenerator(path)
+    return FileGenerator(path, self.partSize)
+
+  def buildBundleGenerator(self, base, package):
+    return BundleGenerator(base, package, self.partSize)
 
-  def buildWriter(self, path, size):
-    writer = FileWriter()
-    writer.open(path, size)
+  def buildWriter(self, path, size, resume=False):
+    writer = FileWriter(self.partSize, self.syncParts)
+    writer.open(path, size, populate=self.preallocate, resume=resume)
     return writer
 
   def putComplete(self, uid):
-    self.transport.loseConnection()
+    self.putNext()
+
+  def transferFailed(self, uid, path, message):
+    self.failed += 1
+
+    if uid is not None:
+      self.putNext()
+
+  def connectionLost(self, reason):
+    self.failed += len(self._send) + self.hashing + len(self.paths) + len(self.bundles)
+    DshProtocol.connectionLost(self, reason)
+
+class DshClientSyncProtocol(DshProtocol):
+  """
+  The default client protocol for synchronizing a directory, only the parts
+  of each file which differ from the remote copy are sent.
+  """
+  """
+  Number of threads used to hash the directory, defaults to one per core.
+  """
+  hashWorkers = None
+
+  def __init__(self, path, cache=None):
+    self.path = path
+    self.cache = cache
+    self.files = collections.deque()
+    self.failed = 0
+
+  def connectionReady(self):
+    files = list(File.opendir(self.path))
+    package = MetaPackage(Hasher(self.hashWorkers, self.cache).metadigest_all(files))
+
+    if self.cache is not None:
+      self.cache.save()
+
+    self.files.extend(zip(files, package.files))
+    self.syncNext()
+
+  def syncNext(self):
+    while self.files and len(self._send) < self.concurrentTransfers:
+      f, meta = self.files.popleft()
+      self.syncFile(self.path, meta, f.get_path())
+
+    if not self._send:
+      self.loseConnection()
+
+  def buildGenerator(self, path):
+    return FileGenerator(path, self.partSize)
+
+  def putComplete(self, uid):
+    self.syncNext()
+
+  def transferFailed(self, uid, path, message):
+    self.failed += 1
+
+    if uid is not None:
+      self.syncNext()
+
+  def connectionLost(self, reason):
+    self.failed += len(self._send) + len(self.files)
+    DshProtocol.connectionLost(self, reason)
 
 class DshClientGetProtocol(DshProtocol):
   """
-  The default client protocol.
+  The default client protocol for getting files, gets every given path over
+  one connection, concurrentTransfers at a time.
+
+  Small files are not bundled on GET: the protocol has no request for
+  several files at once, so each file is its own transfer.
   """
-  def __init__(self, path):
+  def __init__(self, *paths):
     self._files = dict()
-    self.path = path
+    self.paths = collections.deque(paths)
+    self.active = 0
+    self.failed = 0
+
+  def connectionReady(self):
+    self.getNext()
+
+  def getNext(self):
+    while self.paths and self.active < self.concurrentTransfers:
+      self.active += 1
+      self.get(self.paths.popleft())
 
-  def connectionMade(self):
-    self.get(self.path)
+    if self.active == 0:
+      self.loseConnection()
 
   def buildGenerator(self, path):
-    return FileGenerator(path)
+    return FileGenerator(path, self.partSize)
 
-  def buildWriter(self, path, size):
-    writer = FileWriter()
-    writer.open(path, size)
+  def buildWriter(self, path, size, resume=False):
+    writer = FileWriter(self.partSize, self.syncParts)
+    writer.open(path, size, populate=self.preallocate, resume=resume)
     return writer
 
   def getComplete(self, uid):
-    self.transport.loseConnection()
+    self.active -= 1
+    self.getNext()
+
+  def transferFailed(self, uid, path, message):
+    self.failed += 1
+    self.active -= 1
+    self.getNext()
+
+  def connectionLost(self, reason):
+    self.failed += self.active + len(self.paths)
+    DshProtocol.connectionLost(self, reason)
+
+class DshClientStatsProtocol(DshProtocol):
+  """
+  Client protocol which asks for the server's metrics, writes them to
+  'output' as YAML and disconnects.
+  """
+  def __init__(self, output=sys.stdout):
+    self.output = output
+
+  def connectionReady(self):
+    self.stats()
+
+  def dsh_stats_response(self, stats):
+    yaml.safe_dump(stats, self.output, default_flow_style=False)
+    self.loseConnection()
+
+class DshClientFactory(protocol.ClientFactory):
+  def __init__(self, reactor, protocolClass, *args, **kwargs):
+    self.reactor = reactor
+    self.protocolClass = protocolClass
+    self.args = args
+    self.kwargs = kwargs
+    self.client = None
+    self.status = 0
+
+  def buildProtocol(self, addr):
+    p = self.protocolClass(*self.args, **self.kwargs)
+    p.factory = self
+    self.client = p
+    return p
+
+  def clientConnectionFailed(self, transport, reason):
+    print transport, reason
+    self.status = 1
+    self.reactor.stop()
+
+  def clientConnectionLost(self, transport, reason):
+    print transport, reason
+
+    if getattr(self.client, "failed", 0):
+      self.status = 1
+
+    self.reactor.stop()
 
 from zope.interface import implements
 
 from .interface import IWriter
 from .dsh import DshProtocol
 
+def fallocate(fd, size):
+  """
+  Allocate 'size' bytes for the file 'fd', returns False if the platform
+  cannot allocate and the file has only been extended sparsely.
+
+  Only a native fallocate is used, which allocates blocks without writing
+  them and so is quick enough to call from the reactor; posix_fallocate is
+  not, since it writes zeros to every block where the file system cannot
+  allocate.
+  """
+  if size == 0:
+    return True
+
+  if _fallocate is not None:
+    try:
+      _fallocate(fd, 0, size)
+      return True
+    except OSError:
+      pass
+
+  os.ftruncate(fd, size)
+  return False
+
+def _libc_fallocate():
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    f = libc.fallocate64
+  except (ImportError, OSError, AttributeError):
+    return None
+
+  f.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+  def fallocate(fd, offset, size):
+    if f(fd, 0, offset, size) != 0:
+      err = ctypes.get_errno()
+      raise OSError, (err, os.strerror(err))
+
+  return fallocate
+
+def _libc_pwrite():
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    f = libc.pwrite64
+    address = ctypes.pythonapi.PyObject_AsReadBuffer
+  except (ImportError, OSError, AttributeError):
+    return None
+
+  f.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+  f.restype = ctypes.c_ssize_t
+  address.argtypes = [ctypes.py_object, ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_ssize_t)]
+
+  def pwrite(fd, data, pos):
+    ptr = ctypes.c_void_p()
+    size = ctypes.c_ssize_t()
+    address(data, ctypes.byref(ptr), ctypes.byref(size))
+    n = f(fd, ptr, size.value, pos)
+
+    if n < 0:
+      err = ctypes.get_errno()
+      raise OSError, (err, os.strerror(err))
+
+    return n
+
+  return pwrite
+
+_fallocate = _libc_fallocate()
+_pwrite = getattr(os, "pwrite", None) or _libc_pwrite()
+
+def pwrite(fd, data, pos):
+  """
+  Write all of 'data' at 'pos' in the file 'fd'. Without a positional write
+  this seeks first, the caller must then keep other threads from moving the file
+  position meanwhile.
+  """
+  written = 0
+
+  if _pwrite is None:
+    os.lseek(fd, pos, os.SEEK_SET)
+
+  while written < len(data):
+    if _pwrite is None:
+      written += os.write(fd, buffer(data, written))
+    else:
+      written += _pwrite(fd, buffer(data, written), pos + written)
+
 class FileWriter:
-  implements(IWriter)
+  """
+  Writes parts to a file, parts may be written from several threads.
 
-  POPULATE_BUFFER_SIZE = 2 ** 20
+  The file is extended to its full size when opened, allocating its blocks
+  up front if 'populate' is given and the file system can, and parts are
+  written with positional writes. Written data is synced to disk every 'syncParts' parts, on flush
+  and on close.
 
-  def __init__(self):
-    self._fp = None
+  The file is locked while it is open, so that no other transfer, in this
+  or another process, writes it at the same time.
+  """
+  implements(IWriter)
+
+  def __init__(self, partSize=DshProtocol.DATA_MAX, syncParts=0):
+    self._fd = None
     self._size = None
-    self._realsize = None
+    self._partSize = partSize
+    self._syncParts = syncParts
+    self._unsynced = 0
+    self._lock = threading.Lock()
 
-  def open(self, path, size, populate=False):
-    if self._fp:
+  def open(self, path, size, populate=False, resume=False):
+    if self._fd is not None:
       raise RuntimeError, "file already open"
 
-    self._fp = open(path, "w")
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    self._fd = os.open(path, flags, 0666)
     self._size = size
-    self._realsize = 0
 
-    if not populate:
-      return
-
-    nil = 4096 * "\x00"
-    div, mod = divmod(size, self.POPULATE_BUFFER_SIZE)
-    [self._fp.write(nil) for i in xrange(div)]
-    self._fp.write("\x00" * mod)
-    self._realsize = self._size
+    try:
+      if fcntl is not None:
+        try:
+          fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+          raise IOError, "%s is being written by another transfer" % (path)
+
+      if not resume:
+        os.ftruncate(self._fd, 0)
+
+      if os.fstat(self._fd).st_size > size:
+        os.ftruncate(self._fd, size)
+      elif populate:
+        fallocate(self._fd, size)
+      else:
+        os.ftruncate(self._fd, size)
+    except:
+      os.close(self._fd)
+      self._fd = None
+      raise
 
   def write(self, count, data):
-    pos = count * DshProtocol.DATA_MAX
-    if self._realsize < pos:
-      raise ValueError, "cannot seek to position, realsize too small"
-    self._fp.seek(pos)
-    self._fp.write(data)
+    pos = count * self._partSize
+    if self._size < pos + len(data):
+      raise ValueError, "cannot write past end of file"
+
+    if _pwrite is not None:
+      pwrite(self._fd, data, pos)
+    else:
+      with self._lock:
+        pwrite(self._fd, data, pos)
+
+    with self._lock:
+      self._unsynced += 1
+
+      if self._syncParts and self._unsynced >= self._syncParts:
+        self._sync()
+
+  def _sync(self):
+    if self._unsynced > 0:
+      os.fsync(self._fd)
+      self._unsynced = 0
+
+  def keep(self, count, digest):
+    pass
+
+  def flush(self):
+    with self._lock:
+      self._sync()
 
   def close(self):
-    self._fp.close()
-    self._fp = None
-    self._size = None
-    self._realsize = None
+    with self._lock:
+      try:
+        self._sync()
+      finally:
+        os.close(self._fd)
+        self._fd = None
+        self._size = None
 
   def parts(self):
-    parts, mod = divmod(self._size, DshProtocol.DATA_MAX)
+    parts, mod = divmod(self._size, self._partSize)
     if mod != 0: parts += 1
     return parts
 
@@ -115,28 +615,204 @@ from zope.interface import implements
 
 from .interface import IGenerator
 from .dsh import DshProtocol
+from .descriptors import descriptors
 
 class FileGenerator:
+  """
+  Reads parts from a file opened through a DescriptorCache, parts may be
+  read from several threads.
+
+  A part which cannot be read in full, because the file was truncated while
+  being served, fails with an IOError.
+  """
   implements(IGenerator)
 
-  def __init__(self, path):
-    import os
+  def __init__(self, path, partSize=DshProtocol.DATA_MAX, cache=descriptors):
     self._path = path
-    self._size = os.path.getsize(path)
-
-    self._fp = open(path, "r")
+    self._partSize = partSize
+    self._cache = cache
+    self._file = cache.acquire(path)
+    self._size = self._file.size
 
   def read(self, count):
-    pos = count * DshProtocol.DATA_MAX
+    pos = count * self._partSize
     if self._size < pos:
       raise ValueError, "cannot seek to position, size too small"
-    self._fp.seek(pos)
-    return self._fp.read(DshProtocol.DATA_MAX)
+
+    f = self._file
+
+    if f is None:
+      raise ValueError, "generator closed"
+
+    size = min(self._partSize, self._size - pos)
+    data = f.read(pos, size)
+
+    if len(data) < size:
+      raise IOError, "%s was truncated while being read" % (self._path)
+
+    return data
 
   def size(self):
     return self._size
 
   def parts(self):
-    parts, mod = divmod(self._size, DshProtocol.DATA_MAX)
+    parts, mod = divmod(self._size, self._partSize)
     if mod != 0: parts += 1
     return parts
+
+  def key(self):
+    """
+    Identity of the version of the file being read.
+    """
+    return self._file.key
+
+  def close(self):
+    if self._file is not None:
+      self._cache.release(self._file)
+      self._file = None
+
+class Bundle:
+  """
+  Layout of a bundle, the files of a MetaPackage below 'base' stored one
+  after the other.
+  """
+  def __init__(self, base, package, partSize):
+    self._base = base
+    self._files = package.files
+    self._partSize = partSize
+    self._offsets = list()
+    self._size = 0
+
+    for meta in self._files:
+      self._offsets.append(self._size)
+      self._size += meta.size
+
+  def spans(self, pos, size):
+    """
+    Yield (index, offset in file, offset in data, size) for every file which
+    overlaps 'size' bytes of the bundle at 'pos'.
+    """
+    end = pos + size
+    i = max(0, bisect.bisect_right(self._offsets, pos) - 1)
+
+    while i < len(self._files) and self._offsets[i] < end:
+      start = max(pos, self._offsets[i])
+      stop = min(end, self._offsets[i] + self._files[i].size)
+
+      if stop > start:
+        yield i, start - self._offsets[i], start - pos, stop - start
+
+      i += 1
+
+  def path(self, i):
+    return self._files[i].tofile(self._base).get_path()
+
+  def size(self):
+    return self._size
+
+  def parts(self):
+    parts, mod = divmod(self._size, self._partSize)
+    if mod != 0: parts += 1
+    return parts
+
+class BundleGenerator(Bundle):
+  """
+  Reads parts of a bundle, each part holds the data of one or more files.
+  """
+  implements(IGenerator)
+
+  def read(self, count):
+    pos = count * self._partSize
+    if self._size < pos:
+      raise ValueError, "cannot seek to position, size too small"
+
+    data = list()
+
+    for i, offset, at, size in self.spans(pos, self._partSize):
+      fp = open(self.path(i), "rb")
+
+      try:
+        fp.seek(offset)
+        chunk = fp.read(size)
+      finally:
+        fp.close()
+
+      if len(chunk) != size:
+        raise RuntimeError, "file changed while bundled: " + self.path(i)
+
+      data.append(chunk)
+
+    return "".join(data)
+
+  def close(self):
+    pass
+
+class BundleWriter(Bundle):
+  """
+  Unpacks received parts of a bundle directly into its files, which are
+  created on their first write. Parts may be written from several threads.
+
+  Files without any data are only created on close once every part has been
+  written, so that a bundle which is aborted leaves the files it sent no data
+  for alone.
+  """
+  implements(IWriter)
+
+  def __init__(self, base, package, partSize):
+    Bundle.__init__(self, base, package, partSize)
+    self._created = set()
+    self._written = set()
+    self._lock = threading.Lock()
+
+  def open(self, path, size, populate=False, resume=False):
+    if size != self._size:
+      raise ValueError, "bundle size does not match its files"
+
+  def write(self, count, data):
+    pos = count * self._partSize
+    if self._size < pos + len(data):
+      raise ValueError, "cannot write past end of bundle"
+
+    for i, offset, at, size in self.spans(pos, len(data)):
+      fd = self._open(i)
+
+      try:
+        pwrite(fd, buffer(data, at, size), offset)
+      finally:
+        os.close(fd)
+
+    with self._lock:
+      self._written.add(count)
+
+  def _open(self, i):
+    flags = os.O_WRONLY | getattr(os, "O_BINARY", 0)
+
+    with self._lock:
+      if i in self._created:
+        return os.open(self.path(i), flags)
+
+      path = self.path(i)
+      directory = os.path.dirname(path)
+
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+      fd = os.open(path, flags | os.O_CREAT | os.O_TRUNC, 0666)
+      os.ftruncate(fd, self._files[i].size)
+      self._created.add(i)
+      return fd
+
+  def keep(self, count, digest):
+    pass
+
+  def flush(self):
+    pass
+
+  def close(self):
+    if len(self._written) < self.parts():
+      return
+
+    for i in xrange(len(self._files)):
+      if i not in self._created:
+        os.close(self._open(i))
+
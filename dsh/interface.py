@@ -2,7 +2,7 @@ from zope.interface import Interface, Attribute, implements
 
 class IGenerator(Interface):
   def read(self, count):
-    """Read and return a string which is of maximum size DshProtocol.DATA_MAX"""
+    """Read and return a string or buffer of at most the agreed part size"""
 
   def size(self):
     """Return the total amount of parts from this generator"""
@@ -10,14 +10,18 @@ class IGenerator(Interface):
   def parts(self):
     """Return the number of parts this generator will occupy"""
 
+  def close(self):
+    """Release the source once the transfer has ended"""
+
 class IWriter(Interface):
-  def open(self, path, size, populate=False):
+  def open(self, path, size, populate=False, resume=False):
     """
     Allocate and open a stream to the target.
     
     path     - path to write size
     size     - size of the file in bytes
-    populate - indicates weither file should be pre-populated with zeroes.
+    populate - indicates weither the space of the file should be allocated.
+    resume   - indicates weither existing data at the target should be kept.
     """
 
   def write(self, count, data):
@@ -27,6 +31,17 @@ class IWriter(Interface):
     @raise RuntimeError if problem arises during writing.
     """
   
+  def keep(self, count, digest):
+    """
+    Part 'count', with the SHA1 'digest', is already present at the target
+    and is not written.
+    """
+
+  def flush(self):
+    """
+    Flush written data to the target.
+    """
+
   def close(self):
     """
     Close the writer.
@@ -0,0 +1,168 @@
+import time
+
+class Histogram:
+  """
+  Histogram of latencies in power-of-two buckets, bucket i counts the
+  latencies of less than 2**i microseconds which are not in bucket i-1.
+  """
+  BUCKETS = 32
+
+  def __init__(self):
+    self.buckets = [0] * self.BUCKETS
+    self.count = 0
+    self.total = 0
+
+  def add(self, seconds):
+    us = max(0, int(seconds * 1e6))
+    self.buckets[min(us.bit_length(), self.BUCKETS - 1)] += 1
+    self.count += 1
+    self.total += us
+
+  def percentile(self, p):
+    """
+    Upper bound in microseconds of the 'p' percentile, 0 if empty.
+    """
+    need = self.count * p / 100.0
+    seen = 0
+
+    for i, n in enumerate(self.buckets):
+      seen += n
+
+      if n and seen >= need:
+        return 2 ** i
+
+    return 0
+
+  def snapshot(self):
+    return {
+      "count": self.count,
+      "sum_us": self.total,
+      "p50_us": self.percentile(50),
+      "p99_us": self.percentile(99),
+      "buckets": [[2 ** i, n] for i, n in enumerate(self.buckets) if n],
+    }
+
+class Transfer:
+  """
+  Counters of a single transfer in one direction.
+  """
+  def __init__(self, uid, direction, path, size):
+    self.uid = uid
+    self.direction = direction
+    self.path = path
+    self.size = size
+    self.started = time.time()
+    self.bytes = 0
+    self.parts = 0
+    self.mismatches = 0
+    self.latency = Histogram()
+
+  def snapshot(self, now):
+    elapsed = max(now - self.started, 1e-6)
+
+    return {
+      "uid": self.uid.encode("hex"),
+      "direction": self.direction,
+      "path": str(self.path),
+      "size": self.size,
+      "bytes": self.bytes,
+      "parts": self.parts,
+      "mismatches": self.mismatches,
+      "elapsed_ms": int(elapsed * 1000),
+      "bytes_per_s": int(self.bytes / elapsed),
+      "latency": self.latency.snapshot(),
+    }
+
+class Metrics:
+  """
+  Process-wide registry of transfer metrics.
+
+  Counts bytes and parts sent and received, in total and per active
+  transfer, digest mismatches, and the latency from requesting a part to
+  receiving it. Metrics are only updated from the reactor thread, so every
+  update is a plain increment. Snapshots hold only strings, integers, lists
+  and dicts, so they can be bencoded.
+  """
+  def __init__(self):
+    self.started = time.time()
+    self.transfers = dict()
+    self.bytesSent = 0
+    self.bytesReceived = 0
+    self.partsSent = 0
+    self.partsReceived = 0
+    self.mismatches = 0
+    self.completed = 0
+    self.failed = 0
+    self.latency = Histogram()
+
+  def start(self, uid, direction, path, size):
+    """
+    Start counting transfer 'uid', 'direction' is "send" or "recv".
+    """
+    self.transfers[(uid, direction)] = Transfer(uid, direction, path, size)
+
+  def finish(self, uid, direction, ok=True):
+    if self.transfers.pop((uid, direction), None) is None:
+      return
+
+    if ok:
+      self.completed += 1
+    else:
+      self.failed += 1
+
+  def sent(self, uid, size):
+    self.bytesSent += size
+    self.partsSent += 1
+    t = self.transfers.get((uid, "send"))
+
+    if t is not None:
+      t.bytes += size
+      t.parts += 1
+
+  def received(self, uid, size, latency):
+    self.bytesReceived += size
+    self.partsReceived += 1
+    self.latency.add(latency)
+    t = self.transfers.get((uid, "recv"))
+
+    if t is not None:
+      t.bytes += size
+      t.parts += 1
+      t.latency.add(latency)
+
+  def mismatch(self, uid):
+    self.mismatches += 1
+    t = self.transfers.get((uid, "recv"))
+
+    if t is not None:
+      t.mismatches += 1
+
+  def snapshot(self, limit=256):
+    """
+    Return the current metrics, with at most 'limit' of the active transfers,
+    the longest running first.
+    """
+    now = time.time()
+    uptime = max(now - self.started, 1e-6)
+    transfers = sorted(self.transfers.values(), key=lambda t: t.started)
+
+    return {
+      "uptime_ms": int(uptime * 1000),
+      "bytes_sent": self.bytesSent,
+      "bytes_received": self.bytesReceived,
+      "parts_sent": self.partsSent,
+      "parts_received": self.partsReceived,
+      "bytes_sent_per_s": int(self.bytesSent / uptime),
+      "bytes_received_per_s": int(self.bytesReceived / uptime),
+      "digest_mismatches": self.mismatches,
+      "transfers_active": len(self.transfers),
+      "transfers_completed": self.completed,
+      "transfers_failed": self.failed,
+      "latency": self.latency.snapshot(),
+      "transfers": [t.snapshot(now) for t in transfers[:limit]],
+    }
+
+"""
+The metrics shared by every connection in this process.
+"""
+metrics = Metrics()
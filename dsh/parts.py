@@ -0,0 +1,222 @@
+import bencode
+
+from twisted.internet import defer
+
+class PartTracker:
+  """
+  Compact record of which parts of a transfer have been received.
+
+  Parts are kept in a bitmap, one bit per part, together with a request
+  cursor (every part below it has been handed out by take). The cursor only
+  moves forward, so finding the next missing part is amortized O(1) over a
+  transfer.
+  """
+  def __init__(self, parts, bitmap=None):
+    size = (parts + 7) / 8
+
+    if bitmap is None:
+      bitmap = bytearray(size)
+    elif len(bitmap) != size:
+      raise ValueError, "bitmap does not match number of parts"
+
+    self.parts = parts
+    self.bitmap = bytearray(bitmap)
+    self.received = sum(bin(b).count("1") for b in self.bitmap)
+    self._cursor = 0
+
+  def __contains__(self, count):
+    return bool(self.bitmap[count >> 3] & (1 << (count & 7)))
+
+  def add(self, count):
+    """
+    Mark part 'count' as received, returns False if it already was.
+    """
+    if count < 0 or count >= self.parts:
+      raise ValueError, "part out of range"
+
+    bit = 1 << (count & 7)
+
+    if self.bitmap[count >> 3] & bit:
+      return False
+
+    self.bitmap[count >> 3] |= bit
+    self.received += 1
+    return True
+
+  def discard(self, count):
+    """
+    Mark part 'count' as not received, it is not handed out by take again.
+    """
+    bit = 1 << (count & 7)
+
+    if not self.bitmap[count >> 3] & bit:
+      return
+
+    self.bitmap[count >> 3] &= ~bit & 0xff
+    self.received -= 1
+
+  def complete(self):
+    return self.received == self.parts
+
+  def missing(self):
+    return self.parts - self.received
+
+  def _next(self, count):
+    """
+    Find the first missing part at or after 'count', or None.
+    """
+    bitmap = self.bitmap
+
+    while count < self.parts:
+      if count & 7 == 0 and bitmap[count >> 3] == 0xff:
+        count += 8
+        continue
+
+      if not bitmap[count >> 3] & (1 << (count & 7)):
+        return count
+
+      count += 1
+
+    return None
+
+  def take(self, n):
+    """
+    Hand out up to 'n' missing parts that have not been handed out before, as
+    a list of contiguous (start, count) runs.
+    """
+    runs = []
+
+    while n > 0:
+      start = self._next(self._cursor)
+
+      if start is None:
+        self._cursor = self.parts
+        break
+
+      end = start + 1
+
+      while end < self.parts and end - start < n and end not in self:
+        end += 1
+
+      runs.append((start, end - start))
+      n -= end - start
+      self._cursor = end
+
+    return runs
+
+class ReceiveState:
+  """
+  Receive state of a single transfer, the received parts and their digests,
+  which can be persisted so that an interrupted transfer can be resumed.
+
+  Parts which have been received but are still being written are kept in
+  'writing', and are left out when the state is persisted; 'saving' is set
+  while the state itself is being persisted. Transfers which are not
+  'resumable' are never persisted.
+  """
+  def __init__(self, uid, path, size, parts, digestSize, bitmap=None, digests=None):
+    if digests is None:
+      digests = bytearray(parts * digestSize)
+    elif len(digests) != parts * digestSize:
+      raise ValueError, "digests do not match number of parts"
+
+    self.uid = uid
+    self.path = path
+    self.size = size
+    self.digestSize = digestSize
+    self.parts = PartTracker(parts, bitmap)
+    self.digests = bytearray(digests)
+    self.unsaved = 0
+    self.writing = set()
+    self.saving = False
+    self.resumable = True
+    self.version = None
+    self._drained = list()
+
+  def add(self, count, digest):
+    """
+    Mark part 'count' as received with 'digest', returns False if it already
+    was.
+    """
+    if not self.parts.add(count):
+      return False
+
+    self.digests[count * self.digestSize:(count + 1) * self.digestSize] = digest
+    self.unsaved += 1
+    return True
+
+  def written(self, count, ok=True):
+    """
+    Mark part 'count' as written, or as missing again if writing it failed.
+    """
+    self.writing.discard(count)
+
+    if not ok:
+      self.parts.discard(count)
+
+    self._drain()
+
+  def saved(self):
+    self.saving = False
+    self._drain()
+
+  def busy(self):
+    return bool(self.writing) or self.saving
+
+  def drained(self):
+    """
+    Return a Deferred which fires once no parts or state are being written.
+    """
+    d = defer.Deferred()
+    self._drained.append(d)
+    self._drain()
+    return d
+
+  def _drain(self):
+    if self.busy():
+      return
+
+    drained, self._drained = self._drained, list()
+
+    for d in drained:
+      d.callback(None)
+
+  def get_digest(self, count):
+    return str(self.digests[count * self.digestSize:(count + 1) * self.digestSize])
+
+  def complete(self):
+    return self.parts.complete()
+
+  def take(self, n):
+    return self.parts.take(n)
+
+  def dump(self):
+    bitmap = bytearray(self.parts.bitmap)
+
+    for count in self.writing:
+      bitmap[count >> 3] &= ~(1 << (count & 7)) & 0xff
+
+    return {
+      "uid": self.uid,
+      "path": self.path,
+      "size": self.size,
+      "parts": self.parts.parts,
+      "digestSize": self.digestSize,
+      "bitmap": str(bitmap),
+      "digests": str(self.digests),
+      "version": self.version or "",
+    }
+
+  def dumps(self):
+    return bencode.bencode(self.dump())
+
+  @classmethod
+  def load(klass, h):
+    recv = klass(h.get("uid"), h.get("path"), h.get("size"), h.get("parts"),
+        h.get("digestSize"), h.get("bitmap"), h.get("digests"))
+    recv.version = h.get("version")
+    return recv
+
+  @classmethod
+  def loads(klass, s):
+    return klass.load(bencode.bdecode(s))
@@ -0,0 +1,88 @@
+from twisted.python import log
+
+class BufferPool:
+  """
+  Process-wide pool of receive buffers.
+
+  Buffers are handed out in power-of-two size classes and are only leased
+  while a partial frame is pending, so idle connections hold no buffer at all.
+  Once more than 'limit' bytes are leased, readers which need another buffer
+  are told to pause reading until enough buffers have been returned.
+  """
+  MIN_SIZE = 2 ** 12
+
+  def __init__(self, limit=256 * 2 ** 20, keep=32 * 2 ** 20):
+    """
+    limit - bytes which may be leased before transports are paused.
+    keep  - bytes of returned buffers kept around for reuse.
+    """
+    self.limit = limit
+    self.keep = keep
+    self.leased = 0
+    self.kept = 0
+    self.free = dict()
+    self.waiting = list()
+
+  def size_class(self, size):
+    c = self.MIN_SIZE
+
+    while c < size:
+      c <<= 1
+
+    return c
+
+  def lease(self, size):
+    c = self.size_class(size)
+    free = self.free.get(c)
+
+    if free:
+      buf = free.pop()
+      self.kept -= c
+    else:
+      buf = bytearray(c)
+
+    self.leased += c
+    return buf
+
+  def release(self, buf):
+    c = len(buf)
+    self.leased -= c
+
+    if self.kept + c <= self.keep:
+      self.free.setdefault(c, list()).append(buf)
+      self.kept += c
+
+    self.wake()
+
+  def exceeded(self):
+    return self.leased > self.limit
+
+  def wait(self, reader):
+    """
+    Pause 'reader' until the pool is below its limit again, the reader must
+    provide pauseReading(reason) and resumeReading(reason) and should not
+    hold a leased buffer while it waits.
+    """
+    if reader in self.waiting:
+      return
+
+    reader.pauseReading(self)
+    self.waiting.append(reader)
+
+  def cancel(self, reader):
+    if reader in self.waiting:
+      self.waiting.remove(reader)
+
+  def wake(self):
+    while self.waiting and not self.exceeded():
+      reader = self.waiting.pop(0)
+
+      try:
+        reader.resumeReading(self)
+      except:
+        log.err(None, "cannot resume %r" % (reader,))
+
+"""
+The pool shared by every connection in this process.
+"""
+pool = BufferPool()
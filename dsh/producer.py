@@ -0,0 +1,111 @@
+from zope.interface import implements
+from twisted.internet.interfaces import IPushProducer
+
+import collections
+
+class PartProducer:
+  """
+  Streaming producer which serves queued part requests for a DshProtocol.
+
+  Parts are only read from their generator once the transport is ready to
+  accept more data, so memory in use is bounded by the transport buffer and
+  not by how many parts the peer has requested. At most protocol.readAhead
+  parts are being read at the same time.
+
+  Requests are queued per transfer and served in weighted round-robin, each
+  transfer gets protocol.transferWeight(uid) parts per turn, so that a large
+  transfer does not hold up the others sharing the connection.
+  """
+  implements(IPushProducer)
+
+  def __init__(self, protocol):
+    self.protocol = protocol
+    self.pending = dict()
+    self.order = collections.deque()
+    self.credit = 0
+    self.paused = False
+    self.producing = False
+    self.reading = 0
+
+  def queue(self, uid, count):
+    parts = self.pending.get(uid)
+
+    if parts is None:
+      parts = self.pending[uid] = collections.deque()
+      self.order.append(uid)
+
+    parts.append(count)
+
+    if not self.paused:
+      self.resumeProducing()
+
+  def pauseProducing(self):
+    self.paused = True
+
+  def resumeProducing(self):
+    self.paused = False
+
+    if self.producing:
+      return
+
+    self.producing = True
+
+    try:
+      while self.pending and not self.paused:
+        if self.reading >= self.protocol.readAhead:
+          break
+
+        uid, count = self.next()
+        d = self.protocol.producePart(uid, count)
+
+        if d is not None:
+          self.reading += 1
+          d.addBoth(self._produced)
+    finally:
+      self.producing = False
+
+  def next(self):
+    """
+    Take the next part to produce, as (uid, count).
+    """
+    uid = self.order[0]
+
+    if self.credit <= 0:
+      self.credit = max(1, self.protocol.transferWeight(uid))
+
+    parts = self.pending[uid]
+    count = parts.popleft()
+    self.credit -= 1
+
+    if not parts:
+      del self.pending[uid]
+      self.order.popleft()
+      self.credit = 0
+    elif self.credit <= 0:
+      self.order.rotate(-1)
+
+    return uid, count
+
+  def cancel(self, uid):
+    """
+    Drop the queued parts of transfer 'uid'.
+    """
+    if self.pending.pop(uid, None) is None:
+      return
+
+    if self.order[0] == uid:
+      self.credit = 0
+
+    self.order.remove(uid)
+
+  def _produced(self, result):
+    self.reading -= 1
+
+    if not self.paused:
+      self.resumeProducing()
+
+  def stopProducing(self):
+    self.pending.clear()
+    self.order.clear()
+    self.credit = 0
+    self.paused = True
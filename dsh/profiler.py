@@ -0,0 +1,202 @@
+import collections
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from twisted.internet import reactor
+from twisted.python import log
+
+class Profiler:
+  """
+  Process-wide profiling hooks which can be switched on at runtime.
+
+  While timing is enabled, every function wrapped by timed() is counted and
+  timed by name; while it is disabled timed() returns the function itself,
+  so the hooks cost one attribute lookup. Independently of timing, capture()
+  writes a cProfile dump of the reactor thread, or a sampled profile of the
+  stacks of every thread in collapsed format, after a given number of
+  seconds.
+
+  Timed functions may run in the storage pool, so timings are kept under a
+  lock.
+  """
+  def __init__(self, directory=None, interval=0.005):
+    """
+    directory - where captures are written, defaults to the temp directory.
+    interval  - seconds between stack samples.
+    """
+    self.directory = directory or tempfile.gettempdir()
+    self.interval = interval
+    self.enabled = False
+    self.capturing = False
+    self.timings = dict()
+    self._lock = threading.Lock()
+
+  def timed(self, f, name=None):
+    """
+    Return 'f', wrapped to be timed as 'name' if timing is enabled. The name
+    defaults to that of 'f', with its class for bound methods.
+    """
+    if not self.enabled:
+      return f
+
+    if name is None:
+      name = f.__name__
+
+      if getattr(f, "im_self", None) is not None:
+        name = "%s.%s" % (f.im_self.__class__.__name__, name)
+
+    def timed(*args, **kwargs):
+      start = time.time()
+
+      try:
+        return f(*args, **kwargs)
+      finally:
+        self.record(name, time.time() - start)
+
+    return timed
+
+  def record(self, name, seconds):
+    with self._lock:
+      t = self.timings.get(name)
+
+      if t is None:
+        t = self.timings[name] = [0, 0.0, 0.0]
+
+      t[0] += 1
+      t[1] += seconds
+      t[2] = max(t[2], seconds)
+
+  def enable(self):
+    with self._lock:
+      self.timings.clear()
+
+    self.enabled = True
+    log.msg("profiler: timing enabled")
+
+  def disable(self):
+    self.enabled = False
+
+    for name, t in sorted(self.snapshot().items(), key=lambda i: -i[1]["total_us"]):
+      log.msg("profiler: %s %d calls %d us, max %d us" % (
+          name, t["calls"], t["total_us"], t["max_us"]))
+
+  def toggle(self):
+    if self.enabled:
+      self.disable()
+    else:
+      self.enable()
+
+  def snapshot(self):
+    """
+    Return the timings as name: {calls, total_us, max_us}.
+    """
+    with self._lock:
+      return dict((name, {
+        "calls": t[0],
+        "total_us": int(t[1] * 1e6),
+        "max_us": int(t[2] * 1e6),
+      }) for name, t in self.timings.items())
+
+  def capture(self, seconds=10, mode="cprofile"):
+    """
+    Profile for 'seconds' and write the result to a file, 'mode' is
+    "cprofile" or "sample". Returns the path of the file, or None if a
+    capture is already running. Must be called from the reactor thread.
+    """
+    if self.capturing:
+      log.msg("profiler: capture already running")
+      return None
+
+    path = os.path.join(self.directory, "dsh-%d-%d.%s" % (
+        os.getpid(), int(time.time()), mode == "sample" and "stacks" or "prof"))
+
+    if mode == "sample":
+      t = threading.Thread(target=self._sample, args=(path, seconds), name="dsh-sampler")
+      t.daemon = True
+      t.start()
+    elif mode == "cprofile":
+      import cProfile
+      p = cProfile.Profile()
+      p.enable()
+      reactor.callLater(seconds, self._dump, p, path)
+    else:
+      raise ValueError, "unknown profile mode: " + mode
+
+    self.capturing = True
+    log.msg("profiler: capturing %s for %d seconds" % (path, seconds))
+    return path
+
+  def _dump(self, p, path):
+    p.disable()
+
+    try:
+      p.dump_stats(path)
+      log.msg("profiler: wrote " + path)
+    except Exception, e:
+      log.msg("profiler: cannot write %s: %s" % (path, str(e)))
+
+    self.capturing = False
+
+  def _sample(self, path, seconds):
+    own = threading.current_thread().ident
+    names = dict()
+    counts = collections.defaultdict(int)
+    until = time.time() + seconds
+
+    while time.time() < until:
+      for ident, frame in sys._current_frames().items():
+        if ident == own:
+          continue
+
+        if ident not in names:
+          names = dict((t.ident, t.name) for t in threading.enumerate())
+
+        stack = list()
+
+        while frame is not None:
+          code = frame.f_code
+          stack.append("%s (%s:%d)" % (code.co_name,
+              os.path.basename(code.co_filename), code.co_firstlineno))
+          frame = frame.f_back
+
+        stack.append(names.get(ident, str(ident)))
+        counts[";".join(reversed(stack))] += 1
+
+      time.sleep(self.interval)
+
+    try:
+      fp = open(path, "w")
+
+      try:
+        for stack, count in sorted(counts.items()):
+          fp.write("%s %d\n" % (stack, count))
+      finally:
+        fp.close()
+
+      message = "profiler: wrote " + path
+    except Exception, e:
+      message = "profiler: cannot write %s: %s" % (path, str(e))
+
+    reactor.callFromThread(self._sampled, message)
+
+  def _sampled(self, message):
+    log.msg(message)
+    self.capturing = False
+
+  def install(self, seconds=10, mode="cprofile"):
+    """
+    Toggle timing on SIGUSR1 and capture for 'seconds' in 'mode' on SIGUSR2.
+    """
+    signal.signal(signal.SIGUSR1,
+        lambda signum, frame: reactor.callFromThread(self.toggle))
+    signal.signal(signal.SIGUSR2,
+        lambda signum, frame: reactor.callFromThread(self.capture, seconds, mode))
+
+"""
+The profiler shared by every connection in this process.
+"""
+profiler = Profiler()
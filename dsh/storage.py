@@ -0,0 +1,33 @@
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+class Storage:
+  """
+  Runs blocking reads and writes of generators and writers on a bounded pool
+  of threads, so that a slow disk never stalls the reactor.
+  """
+  def __init__(self, threads=4):
+    self.threads = threads
+    self.pool = None
+
+  def run(self, f, *args, **kwargs):
+    """
+    Call 'f' in the thread pool, returns a Deferred with its result.
+    """
+    if self.pool is None:
+      self.pool = ThreadPool(0, self.threads, "dsh-storage")
+      self.pool.start()
+      reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    return threads.deferToThreadPool(reactor, self.pool, f, *args, **kwargs)
+
+  def stop(self):
+    if self.pool is not None:
+      self.pool.stop()
+      self.pool = None
+
+"""
+The storage thread pool shared by every connection in this process.
+"""
+storage = Storage()
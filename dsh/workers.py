@@ -0,0 +1,144 @@
+import errno
+import os
+import signal
+import socket
+import time
+
+from twisted.python import log
+
+def listenSocket(port, interface="", reusePort=True):
+  """
+  Return a listening, non-blocking TCP socket on 'port', with SO_REUSEPORT
+  set if 'reusePort' is given, so that several sockets may share the port.
+  """
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reusePort:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    sock.bind((interface, port))
+    sock.listen(50)
+    sock.setblocking(False)
+  except:
+    sock.close()
+    raise
+
+  return sock
+
+class Supervisor:
+  """
+  Runs 'workers' server processes accepting connections on the same port.
+
+  Where SO_REUSEPORT is available every worker gets its own listening socket
+  and the kernel spreads connections over them, otherwise all workers accept
+  from one shared socket. The sockets are bound by the supervisor before
+  forking and kept open, so that a worker which died is restarted on the
+  same socket without refusing connections meanwhile. SIGTERM and SIGINT stop
+  the workers, SIGUSR1 and SIGUSR2 are passed on to them.
+
+  Workers are forked before the reactor is created, run(index, sock) is
+  called in each of them and must serve 'sock' until stopped.
+  """
+  """
+  Seconds to wait before restarting a worker which died.
+  """
+  restartDelay = 1
+
+  def __init__(self, workers, run, port, interface=""):
+    self.workers = workers
+    self.run = run
+    self.children = dict()
+    self.stopping = False
+    self.sockets = list()
+
+    if hasattr(socket, "SO_REUSEPORT"):
+      try:
+        for i in xrange(workers):
+          self.sockets.append(listenSocket(port, interface))
+      except socket.error, e:
+        for sock in self.sockets:
+          sock.close()
+
+        if e.errno != errno.ENOPROTOOPT:
+          raise
+
+        self.sockets = list()
+
+    if not self.sockets:
+      self.sockets = [listenSocket(port, interface, reusePort=False)] * workers
+
+  def start(self, index):
+    pid = os.fork()
+
+    if pid != 0:
+      self.children[pid] = index
+      return
+
+    status = 0
+
+    try:
+      for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+
+      for signum in (signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, signal.SIG_IGN)
+
+      for sock in set(self.sockets):
+        if sock is not self.sockets[index]:
+          sock.close()
+
+      self.run(index, self.sockets[index])
+    except:
+      log.err(None, "worker %d failed" % (index))
+      status = 1
+    finally:
+      os._exit(status)
+
+  def forward(self, signum, frame):
+    if signum in (signal.SIGTERM, signal.SIGINT):
+      self.stopping = True
+      signum = signal.SIGTERM
+
+    for pid in self.children:
+      try:
+        os.kill(pid, signum)
+      except OSError, e:
+        pass
+
+  def serve(self):
+    """
+    Start the workers and restart any that die, until stopped.
+    """
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2):
+      signal.signal(signum, self.forward)
+
+    for index in xrange(self.workers):
+      self.start(index)
+
+    log.msg("started %d workers" % (self.workers))
+
+    while self.children:
+      try:
+        pid, status = os.wait()
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+
+        raise
+
+      index = self.children.pop(pid, None)
+
+      if index is None or self.stopping:
+        continue
+
+      log.msg("worker %d (pid %d) exited with status %d, restarting" % (index, pid, status))
+      time.sleep(self.restartDelay)
+
+      if not self.stopping:
+        self.start(index)
+
+    for sock in set(self.sockets):
+      sock.close()
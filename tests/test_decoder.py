@@ -0,0 +1,156 @@
+import struct
+import unittest
+
+from dsh.decoder import FrameDecoder
+from dsh.pool import BufferPool
+
+class Receiver:
+  """
+  Protocol side of a FrameDecoder which records the frames it is given.
+  """
+  frames = {
+    "a": struct.Struct("!I4s"),
+    "b": struct.Struct("!I"),
+  }
+
+  bufferCommands = set(["b"])
+
+  def __init__(self, limit=1024):
+    self.limit = limit
+    self.received = list()
+    self.paused = set()
+    self.decoder = None
+    self.detach = False
+
+  def frameStruct(self, c):
+    return self.frames.get(c)
+
+  def frameSize(self, size):
+    return size <= self.limit
+
+  def frameReceived(self, c, info, data):
+    if self.detach:
+      self.detached = self.decoder.detach()
+
+    if isinstance(data, buffer):
+      data = ("buffer", str(data))
+
+    self.received.append((c, info, data))
+
+  def pauseReading(self, reason):
+    self.paused.add(reason)
+
+  def resumeReading(self, reason):
+    self.paused.discard(reason)
+
+def frame(c, data, *info):
+  return c + Receiver.frames[c].pack(len(data), *info) + data
+
+class FrameDecoderTest(unittest.TestCase):
+  def setUp(self):
+    self.pool = BufferPool()
+    self.receiver = Receiver()
+    self.decoder = FrameDecoder(self.receiver, self.pool)
+    self.receiver.decoder = self.decoder
+
+  def feed(self, data, step):
+    for i in xrange(0, len(data), step):
+      self.decoder.feed(data[i:i + step])
+
+  def test_frames_in_one_segment(self):
+    self.decoder.feed(frame("a", "hello", "abcd") + frame("b", "world") + frame("a", "", "efgh"))
+
+    self.assertEqual(self.receiver.received, [
+      ("a", ("abcd",), "hello"),
+      ("b", (), ("buffer", "world")),
+      ("a", ("efgh",), None),
+    ])
+    self.assertEqual(self.pool.leased, 0)
+
+  def test_zero_length_frames(self):
+    self.feed(frame("b", "") * 3, 1)
+
+    self.assertEqual(self.receiver.received, [("b", (), None)] * 3)
+
+  def test_header_split_over_segments(self):
+    data = frame("a", "payload", "wxyz")
+
+    for step in xrange(1, len(data)):
+      del self.receiver.received[:]
+      self.feed(data * 2, step)
+
+      self.assertEqual(self.receiver.received, [("a", ("wxyz",), "payload")] * 2)
+
+  def test_payload_split_over_segments(self):
+    payload = "".join(chr(i % 256) for i in xrange(1000))
+    data = frame("b", payload) + frame("a", payload, "abcd")
+    self.feed(data, 7)
+
+    self.assertEqual(self.receiver.received, [
+      ("b", (), ("buffer", payload)),
+      ("a", ("abcd",), payload),
+    ])
+    self.assertEqual(self.pool.leased, 0)
+
+  def test_split_payload_buffer_can_be_detached(self):
+    self.receiver.detach = True
+    self.feed(frame("b", "x" * 100), 30)
+
+    self.assertEqual(self.receiver.received, [("b", (), ("buffer", "x" * 100))])
+    self.assertEqual(self.pool.leased, len(self.receiver.detached))
+
+    self.pool.release(self.receiver.detached)
+    self.assertEqual(self.pool.leased, 0)
+
+  def test_close_releases_partial_buffer(self):
+    self.feed(frame("b", "x" * 100)[:50], 50)
+    self.assertNotEqual(self.pool.leased, 0)
+
+    self.decoder.close()
+    self.assertEqual(self.pool.leased, 0)
+
+  def test_unknown_command_breaks(self):
+    self.decoder.feed("z" + frame("a", "x", "abcd"))
+
+    self.assertTrue(self.decoder.broken)
+    self.assertEqual(self.receiver.received, [])
+
+  def test_oversized_payload_breaks(self):
+    self.decoder.feed(frame("b", "x" * 2000))
+
+    self.assertTrue(self.decoder.broken)
+    self.assertEqual(self.receiver.received, [])
+
+class PoolLimitTest(unittest.TestCase):
+  def test_connections_mid_frame_finish_over_limit(self):
+    size = 64 * 2 ** 10
+    pool = BufferPool(limit=3 * size)
+    receivers = list()
+    segments = list()
+
+    for i in xrange(7):
+      receiver = Receiver(limit=size)
+      receiver.decoder = FrameDecoder(receiver, pool)
+      receivers.append(receiver)
+
+      data = frame("b", chr(i) * size) * 2
+      segments.append([data[j:j + 10000] for j in xrange(0, len(data), 10000)])
+
+    progress = True
+
+    while progress:
+      progress = False
+
+      for receiver, pending in zip(receivers, segments):
+        if pending and not receiver.paused:
+          receiver.decoder.feed(pending.pop(0))
+          progress = True
+
+    for i, receiver in enumerate(receivers):
+      self.assertEqual(receiver.received, [("b", (), ("buffer", chr(i) * size))] * 2)
+
+    self.assertEqual(pool.leased, 0)
+    self.assertEqual(pool.waiting, [])
+
+if __name__ == "__main__":
+  unittest.main()
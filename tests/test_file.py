@@ -0,0 +1,68 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from dsh.file import File, FileMeta, HashCache
+
+class HashCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.files = list()
+
+    for i in xrange(4):
+      name = "f%d" % (i,)
+
+      with open(os.path.join(self.dir, name), "wb") as fp:
+        fp.write(name)
+
+      self.files.append(File(self.dir, name))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_get_after_put(self):
+    cache = HashCache(os.path.join(self.dir, "cache"))
+    f = self.files[0]
+    stamp = cache.stamp(f)
+    cache.put(f, stamp, FileMeta(f.path, 2, "x" * 20))
+
+    self.assertEqual(cache.get(f, stamp).hashes, "x" * 20)
+    self.assertEqual(cache.get(f, stamp[:-1] + [0]), None)
+    self.assertEqual(cache.entries, {})
+
+  def test_concurrent_put_and_get(self):
+    cache = HashCache(os.path.join(self.dir, "cache"), max_bytes=2000)
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+
+    def work(n):
+      for i in xrange(2000):
+        f = self.files[(i * n) % len(self.files)]
+        stamp = cache.stamp(f)
+
+        cache.put(f, stamp, FileMeta(f.path, 2, chr(n) * 20 * (i % 5)))
+        cache.get(f, stamp)
+
+    try:
+      threads = [threading.Thread(target=work, args=(n,)) for n in xrange(1, 9)]
+
+      for t in threads:
+        t.start()
+
+      for t in threads:
+        t.join()
+    finally:
+      sys.setcheckinterval(interval)
+
+    size = sum(len(k) + len(e["hashes"]) for k, e in cache.entries.items())
+    self.assertEqual(cache.size, size)
+    self.assertTrue(cache.size <= cache.max_bytes)
+
+    cache.save()
+    self.assertEqual(HashCache(cache.path).entries, cache.entries)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from dsh import impl
+from dsh.file import FileMeta, MetaPackage
+from dsh.impl import BundleWriter, FileWriter
+
+class FileWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, "file")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def read(self):
+    with open(self.path, "rb") as fp:
+      return fp.read()
+
+  def test_positional_write_is_bound(self):
+    self.assertNotEqual(impl._pwrite, None)
+
+  def test_write_strings_and_buffers(self):
+    writer = FileWriter(partSize=4)
+    writer.open(self.path, 10)
+    writer.write(2, "ij")
+    writer.write(0, buffer("xabcd", 1))
+    writer.write(1, buffer(bytearray("efgh")))
+    writer.close()
+
+    self.assertEqual(self.read(), "abcdefghij")
+
+  def test_write_from_threads(self):
+    writer = FileWriter(partSize=1000)
+    writer.open(self.path, 64 * 1000)
+
+    def work(start):
+      for count in xrange(start, 64, 8):
+        writer.write(count, chr(count) * 1000)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in xrange(8)]
+
+    for t in threads:
+      t.start()
+
+    for t in threads:
+      t.join()
+
+    writer.close()
+    self.assertEqual(self.read(), "".join(chr(i) * 1000 for i in xrange(64)))
+
+  def test_fallocate_allocates_or_extends(self):
+    fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0666)
+
+    try:
+      allocated = impl.fallocate(fd, 2 ** 20)
+      st = os.fstat(fd)
+    finally:
+      os.close(fd)
+
+    self.assertEqual(st.st_size, 2 ** 20)
+
+    if allocated:
+      self.assertTrue(st.st_blocks * 512 >= 2 ** 20)
+
+class BundleWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.package = MetaPackage([
+      FileMeta(["a"], 3, ""),
+      FileMeta(["empty"], 0, ""),
+      FileMeta(["d", "b"], 5, ""),
+    ])
+
+    with open(os.path.join(self.dir, "empty"), "wb") as fp:
+      fp.write("old")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def read(self, *path):
+    with open(os.path.join(self.dir, *path), "rb") as fp:
+      return fp.read()
+
+  def test_complete_bundle_creates_every_file(self):
+    writer = BundleWriter(self.dir, self.package, 4)
+    writer.open(self.dir, 8)
+    writer.write(1, "cdef")
+    writer.write(0, "abxy")
+    writer.close()
+
+    self.assertEqual(self.read("a"), "abx")
+    self.assertEqual(self.read("empty"), "")
+    self.assertEqual(self.read("d", "b"), "ycdef")
+
+  def test_aborted_bundle_leaves_files_without_data_alone(self):
+    writer = BundleWriter(self.dir, self.package, 4)
+    writer.open(self.dir, 8)
+    writer.write(1, "cdef")
+    writer.close()
+
+    self.assertEqual(self.read("empty"), "old")
+    self.assertFalse(os.path.exists(os.path.join(self.dir, "a")))
+
+if __name__ == "__main__":
+  unittest.main()
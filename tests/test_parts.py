@@ -0,0 +1,103 @@
+import unittest
+
+from dsh.parts import PartTracker, ReceiveState
+
+class PartTrackerTest(unittest.TestCase):
+  def test_take_hands_out_runs_once(self):
+    t = PartTracker(20)
+    self.assertEqual(t.take(5), [(0, 5)])
+    self.assertEqual(t.take(3), [(5, 3)])
+    self.assertEqual(t.take(100), [(8, 12)])
+    self.assertEqual(t.take(1), [])
+
+  def test_take_skips_received_parts(self):
+    t = PartTracker(20)
+
+    for count in (0, 1, 2, 5, 6, 9):
+      t.add(count)
+
+    self.assertEqual(t.take(4), [(3, 2), (7, 2)])
+    self.assertEqual(t.take(20), [(10, 10)])
+
+  def test_take_skips_full_bytes(self):
+    t = PartTracker(30)
+
+    for count in xrange(0, 24):
+      t.add(count)
+
+    self.assertEqual(t.take(10), [(24, 6)])
+
+  def test_add_and_discard(self):
+    t = PartTracker(10)
+    self.assertTrue(t.add(3))
+    self.assertFalse(t.add(3))
+    self.assertTrue(3 in t)
+    self.assertEqual(t.missing(), 9)
+
+    t.discard(3)
+    t.discard(3)
+    self.assertFalse(3 in t)
+    self.assertEqual(t.missing(), 10)
+    self.assertRaises(ValueError, t.add, 10)
+    self.assertRaises(ValueError, t.add, -1)
+
+  def test_complete_with_partial_last_byte(self):
+    t = PartTracker(9)
+
+    for count in xrange(9):
+      self.assertFalse(t.complete())
+      t.add(count)
+
+    self.assertTrue(t.complete())
+    self.assertEqual(t.take(5), [])
+
+  def test_resume_from_bitmap(self):
+    t = PartTracker(12)
+
+    for count in (0, 1, 2, 3, 8, 11):
+      t.add(count)
+
+    resumed = PartTracker(12, str(t.bitmap))
+    self.assertEqual(resumed.received, 6)
+    self.assertEqual(resumed.take(12), [(4, 4), (9, 2)])
+    self.assertRaises(ValueError, PartTracker, 12, "\x00")
+
+  def test_empty(self):
+    t = PartTracker(0)
+    self.assertTrue(t.complete())
+    self.assertEqual(t.take(4), [])
+
+class ReceiveStateTest(unittest.TestCase):
+  def test_dump_leaves_out_parts_being_written(self):
+    recv = ReceiveState("u" * 16, "path", 10, 10, 4)
+    recv.add(1, "aaaa")
+    recv.add(2, "bbbb")
+    recv.writing.add(2)
+    recv.version = "v" * 20
+
+    loaded = ReceiveState.loads(recv.dumps())
+    self.assertTrue(1 in loaded.parts)
+    self.assertFalse(2 in loaded.parts)
+    self.assertEqual(loaded.get_digest(1), "aaaa")
+    self.assertEqual(loaded.version, "v" * 20)
+    self.assertEqual(loaded.take(3), [(0, 1), (2, 2)])
+
+  def test_failed_write_is_missing_again(self):
+    recv = ReceiveState("u" * 16, "path", 10, 10, 4)
+    recv.add(4, "dddd")
+    recv.writing.add(4)
+    recv.written(4, False)
+    self.assertFalse(4 in recv.parts)
+    self.assertFalse(recv.busy())
+
+  def test_drained_waits_for_writes(self):
+    recv = ReceiveState("u" * 16, "path", 10, 10, 4)
+    recv.writing.add(0)
+    fired = []
+    recv.drained().addCallback(fired.append)
+    self.assertEqual(fired, [])
+    recv.written(0)
+    self.assertEqual(fired, [None])
+
+if __name__ == "__main__":
+  unittest.main()
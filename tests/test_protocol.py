@@ -0,0 +1,301 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+
+from dsh.dsh import DshProtocol
+from dsh.file import FileMeta, MetaPackage
+from dsh.impl import DshServerProtocol
+from dsh.interface import IGenerator, IWriter
+from dsh.metrics import Metrics
+from zope.interface import implements
+
+class Loopback:
+  """
+  Two protocols connected through string transports, frames move when
+  pump is called.
+  """
+  def __init__(self, client, server):
+    self.client = client
+    self.server = server
+    client.makeConnection(StringTransport())
+    server.makeConnection(StringTransport())
+    self.pump()
+
+  def pump(self):
+    moved = True
+
+    while moved:
+      moved = False
+
+      for a, b in ((self.client, self.server), (self.server, self.client)):
+        a.flushFrames()
+        data = a.transport.value()
+        a.transport.clear()
+
+        if data:
+          b.dataReceived(data)
+          moved = True
+
+  def close(self):
+    for p in (self.client, self.server):
+      if p.connected:
+        p.connectionLost(None)
+
+class Inline:
+  """
+  Storage which runs writes right away instead of in threads.
+  """
+  def run(self, f, *args, **kwargs):
+    return defer.maybeDeferred(f, *args, **kwargs)
+
+class Queued:
+  """
+  Storage which runs calls only once the test runs them.
+  """
+  def __init__(self):
+    self.calls = list()
+
+  def run(self, f, *args, **kwargs):
+    d = defer.Deferred()
+    self.calls.append((d, f, args, kwargs))
+    return d
+
+  def runAll(self):
+    while self.calls:
+      d, f, args, kwargs = self.calls.pop(0)
+      defer.maybeDeferred(f, *args, **kwargs).chainDeferred(d)
+
+class SyncServer(DshProtocol):
+  enableSyncFile = True
+
+  def __init__(self):
+    self.synced = list()
+
+  def dsh_sync(self, uid, size, base, meta, version):
+    self.synced.append((uid, size, base, meta, version))
+
+class SyncTest(unittest.TestCase):
+  def setUp(self):
+    self.client = DshProtocol()
+    self.client.DATA_MAX = 100
+    self.server = SyncServer()
+    self.loop = Loopback(self.client, self.server)
+
+  def tearDown(self):
+    self.loop.close()
+
+  def test_manifest_larger_than_data_max(self):
+    hashes = "".join("%020d" % i for i in xrange(23))
+    self.client.sync("u" * 16, 1000, "base", FileMeta(("a", "b"), 1000, hashes), "w" * 20)
+    self.loop.pump()
+
+    self.assertEqual(len(self.server.synced), 1)
+    uid, size, base, meta, version = self.server.synced[0]
+    self.assertEqual((uid, size, base, version), ("u" * 16, 1000, "base", "w" * 20))
+    self.assertEqual(meta.path, ["a", "b"])
+    self.assertEqual(meta.hashes, hashes)
+    self.assertEqual(meta.hashsize, 23)
+    self.assertEqual(self.server._syncHashes, {})
+
+  def test_empty_manifest(self):
+    self.client.sync("v" * 16, 0, "base", FileMeta(("a",), 0, ""), "w" * 20)
+    self.loop.pump()
+
+    self.assertEqual(self.server.synced[0][3].hashes, "")
+
+class Recorder(DshProtocol):
+  def __init__(self):
+    self.failed = list()
+
+  def transferFailed(self, uid, path, message):
+    self.failed.append((uid, path))
+
+class TransferErrorTest(unittest.TestCase):
+  def setUp(self):
+    self.client = Recorder()
+    self.server = Recorder()
+    self.loop = Loopback(self.client, self.server)
+
+  def tearDown(self):
+    self.loop.close()
+
+  def test_failed_on_both_sides_fails_once(self):
+    uid = "u" * 16
+    self.client.abortTransfer(uid, "a", "cannot read")
+    self.server.abortTransfer(uid, "a", "cannot write")
+    self.loop.pump()
+
+    self.assertEqual(self.client.failed, [(uid, "a")])
+    self.assertEqual(self.server.failed, [(uid, "a")])
+
+  def test_peer_failure_is_reported(self):
+    uid = "u" * 16
+    self.server.abortTransfer(uid, "a", "cannot write")
+    self.loop.pump()
+
+    self.assertEqual(self.client.failed, [(uid, "a")])
+    self.assertTrue(uid in self.client._dropped)
+
+class BundleServer(DshServerProtocol):
+  storage = Inline()
+
+class BundleTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+    for name in ("a", "b"):
+      with open(os.path.join(self.dir, name), "wb") as fp:
+        fp.write("old " + name)
+
+    self.client = DshProtocol()
+    self.server = BundleServer()
+    self.loop = Loopback(self.client, self.server)
+
+  def tearDown(self):
+    self.loop.close()
+    shutil.rmtree(self.dir)
+
+  def read(self, name):
+    with open(os.path.join(self.dir, name), "rb") as fp:
+      return fp.read()
+
+  def test_disconnect_leaves_files_alone(self):
+    package = MetaPackage([FileMeta(["a"], 10, ""), FileMeta(["b"], 0, "")])
+    self.client.bundle("u" * 16, 10, self.dir, package)
+    self.loop.pump()
+
+    self.assertTrue("u" * 16 in self.server._recv)
+    self.loop.close()
+
+    self.assertEqual(self.read("a"), "old a")
+    self.assertEqual(self.read("b"), "old b")
+
+class HaveServer(DshProtocol):
+  enablePutFile = True
+
+class HaveTest(unittest.TestCase):
+  def setUp(self):
+    self.client = Recorder()
+    self.server = HaveServer()
+    self.loop = Loopback(self.client, self.server)
+
+  def tearDown(self):
+    self.loop.close()
+
+  def errors(self, p):
+    errors = list()
+    p.dsh_error = errors.append
+    return errors
+
+  def test_query_is_answered(self):
+    responses = list()
+    self.client.dsh_have_response = lambda uid, start, bitmap: responses.append((start, str(bitmap)))
+    self.client.have("u" * 16, "x" * 20 * 9)
+    self.loop.pump()
+
+    self.assertEqual(responses, [(0, "\x00\x00")])
+
+  def test_empty_query(self):
+    errors = self.errors(self.client)
+    self.client.sendFrame(DshProtocol.HAVE, info=("u" * 16, 0))
+    self.loop.pump()
+
+    self.assertEqual(errors, ["invalid have query"])
+
+  def test_empty_response(self):
+    errors = self.errors(self.client)
+    self.client.sendFrame(DshProtocol.HAVE_RESPONSE, info=("u" * 16, 0))
+    self.loop.pump()
+
+    self.assertEqual(errors, ["invalid have response"])
+
+class Generator:
+  implements(IGenerator)
+
+  def __init__(self, data):
+    self.data = data
+
+  def read(self, count):
+    return self.data
+
+  def size(self):
+    return len(self.data)
+
+  def parts(self):
+    return 1
+
+  def close(self):
+    pass
+
+class FailingWriter:
+  implements(IWriter)
+
+  def open(self, path, size, populate=False, resume=False):
+    pass
+
+  def write(self, count, data):
+    raise IOError, "disk full"
+
+  def keep(self, count, digest):
+    pass
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+  def parts(self):
+    return 1
+
+class PutClient(Recorder):
+  def buildGenerator(self, path):
+    return Generator("data")
+
+class PutServer(Recorder):
+  enablePutFile = True
+  resumeTransfers = False
+
+  def buildWriter(self, path, size, resume=False):
+    return FailingWriter()
+
+class CompleteTest(unittest.TestCase):
+  def setUp(self):
+    self.client = PutClient()
+    self.server = PutServer()
+    self.client.storage = self.server.storage = Queued()
+    self.client.metrics = Metrics()
+    self.server.metrics = Metrics()
+    self.loop = Loopback(self.client, self.server)
+
+  def tearDown(self):
+    self.loop.close()
+
+  def settle(self):
+    """
+    Move frames and storage calls until both sides are idle.
+    """
+    storage = self.client.storage
+
+    while True:
+      self.loop.pump()
+
+      if not storage.calls:
+        break
+
+      storage.runAll()
+
+  def test_failed_last_write_is_counted(self):
+    uid = self.client.putFile("a")
+    self.settle()
+
+    self.assertEqual(self.server.failed, [(uid, "a")])
+    self.assertEqual(self.server.metrics.transfers, {})
+    self.assertEqual(self.server.metrics.failed, 1)
+
+if __name__ == "__main__":
+  unittest.main()